@@ -7,25 +7,27 @@ import polars as pl
 from scipy import stats as sp_stats
 from statsmodels.tsa.stattools import grangercausalitytests
 
-from prt_otp_analysis.common import output_dir, query_to_polars, setup_plotting
+from prt_otp_analysis.common import cached_query_to_polars, output_dir, setup_plotting
 
 HERE = Path(__file__).resolve().parent
 OUT = output_dir(HERE)
+CACHE = HERE / ".cache"
 
 MIN_MONTHS = 36
 MAX_LAG = 6
+MIN_STD = 1e-9  # below this a detrended series is treated as constant
 
 
 def load_data() -> pl.DataFrame:
     """Load paired monthly OTP and weekday ridership for routes with enough data."""
-    df = query_to_polars("""
+    df = cached_query_to_polars("""
         SELECT o.route_id, o.month, o.otp, r.avg_riders
         FROM otp_monthly o
         JOIN ridership_monthly r
             ON o.route_id = r.route_id AND o.month = r.month
             AND r.day_type = 'WEEKDAY'
         ORDER BY o.route_id, o.month
-    """)
+    """, CACHE, "paired_monthly")
 
     # Filter to routes with at least MIN_MONTHS of paired data
     route_counts = df.group_by("route_id").agg(pl.col("month").count().alias("n"))
@@ -51,28 +53,67 @@ def detrend(df: pl.DataFrame) -> pl.DataFrame:
 
 def compute_lagged_crosscorr(df: pl.DataFrame) -> pl.DataFrame:
     """Compute lagged cross-correlations (OTP leading ridership) for each route."""
-    routes = df["route_id"].unique().sort().to_list()
-    results = []
-
-    for route in routes:
-        rdf = df.filter(pl.col("route_id") == route).sort("month")
-        otp = rdf["otp_dt"].to_numpy()
-        riders = rdf["riders_dt"].to_numpy()
-
-        for lag in range(0, MAX_LAG + 1):
-            if lag == 0:
-                r, p = sp_stats.pearsonr(otp, riders)
-            else:
-                # OTP at time t correlated with ridership at time t+lag
-                r, p = sp_stats.pearsonr(otp[:-lag], riders[lag:])
-            results.append({
-                "route_id": route,
-                "lag": lag,
-                "correlation": r,
-                "p_value": p,
-            })
-
-    return pl.DataFrame(results)
+    # Dense route x month-position matrices, zero-padded past each route's last month
+    pos = (
+        df.sort("route_id", "month")
+        .with_columns(
+            ri=pl.col("route_id").rank("dense").cast(pl.Int64) - 1,
+            pi=pl.int_range(pl.len()).over("route_id"),
+        )
+    )
+    # Row labels come from the same sorted frame that assigns the matrix rows
+    routes = pos["route_id"].unique(maintain_order=True).to_numpy()
+    n_routes = len(routes)
+    ri = pos["ri"].to_numpy()
+    pi = pos["pi"].to_numpy()
+    n_pos = int(pi.max()) + 1
+    otp = np.zeros((n_routes, n_pos))
+    riders = np.zeros((n_routes, n_pos))
+    present = np.zeros((n_routes, n_pos))
+    otp[ri, pi] = pos["otp_dt"].to_numpy()
+    riders[ri, pi] = pos["riders_dt"].to_numpy()
+    present[ri, pi] = 1.0
+
+    # Scratch matrices and per-route sums, allocated once and reused for every lag
+    mask_buf = np.empty((n_routes, n_pos))
+    x_buf = np.empty((n_routes, n_pos))
+    y_buf = np.empty((n_routes, n_pos))
+    buf = {k: np.empty(n_routes) for k in ("n", "sx", "sy", "sxx", "syy", "sxy")}
+
+    r = np.empty((n_routes, MAX_LAG + 1))
+    n_eff = np.empty((n_routes, MAX_LAG + 1))
+    for lag in range(0, MAX_LAG + 1):
+        # OTP at time t correlated with ridership at time t+lag
+        w = n_pos - lag
+        m = np.multiply(present[:, :w], present[:, lag:], out=mask_buf[:, :w])
+        x = np.multiply(otp[:, :w], m, out=x_buf[:, :w])
+        y = np.multiply(riders[:, lag:], m, out=y_buf[:, :w])
+        np.sum(m, axis=1, out=buf["n"])
+        np.sum(x, axis=1, out=buf["sx"])
+        np.sum(y, axis=1, out=buf["sy"])
+        np.einsum("ij,ij->i", x, x, out=buf["sxx"])
+        np.einsum("ij,ij->i", y, y, out=buf["syy"])
+        np.einsum("ij,ij->i", x, y, out=buf["sxy"])
+
+        n, sx, sy = buf["n"], buf["sx"], buf["sy"]
+        cov = n * buf["sxy"] - sx * sy
+        var_x = n * buf["sxx"] - sx * sx
+        var_y = n * buf["syy"] - sy * sy
+        r[:, lag] = cov / np.sqrt(var_x * var_y)
+        n_eff[:, lag] = n
+
+    # All p-values in one vectorized t-distribution call
+    r = np.clip(r, -1.0, 1.0)
+    with np.errstate(divide="ignore"):
+        t_stat = r * np.sqrt((n_eff - 2) / (1 - r * r))
+    p = 2 * sp_stats.t.sf(np.abs(t_stat), n_eff - 2)
+
+    return pl.DataFrame({
+        "route_id": np.repeat(routes, MAX_LAG + 1),
+        "lag": np.tile(np.arange(MAX_LAG + 1), n_routes),
+        "correlation": r.ravel(),
+        "p_value": p.ravel(),
+    })
 
 
 def aggregate_crosscorr(ccdf: pl.DataFrame) -> pl.DataFrame:
@@ -91,46 +132,53 @@ def aggregate_crosscorr(ccdf: pl.DataFrame) -> pl.DataFrame:
     )
 
 
-def run_granger_tests(df: pl.DataFrame) -> pl.DataFrame:
-    """Run Granger causality tests (OTP -> ridership) for each route."""
-    routes = df["route_id"].unique().sort().to_list()
+def run_granger_tests(df: pl.DataFrame, routes: list[str]) -> pl.DataFrame:
+    """Run Granger causality tests (OTP -> ridership) for each route in `routes`."""
     n_routes = len(routes)
-    results = []
+    results = {
+        "route_id": [], "best_lag": [], "f_stat": [], "p_value": [],
+        "p_bonferroni": [], "n_months": [],
+    }
 
+    by_route = df.sort("month").partition_by("route_id", as_dict=True)
     for route in routes:
-        rdf = df.filter(pl.col("route_id") == route).sort("month")
+        rdf = by_route[(route,)]
         otp = rdf["otp_dt"].to_numpy()
         riders = rdf["riders_dt"].to_numpy()
 
-        # statsmodels expects [y, x] where we test if x Granger-causes y
-        data = np.column_stack([riders, otp])
-
         best_lag = None
         best_p = 1.0
         best_f = 0.0
 
-        try:
-            res = grangercausalitytests(data, maxlag=MAX_LAG, verbose=False)
-            for lag in range(1, MAX_LAG + 1):
-                f_stat = res[lag][0]["ssr_ftest"][0]
-                p_val = res[lag][0]["ssr_ftest"][1]
-                if p_val < best_p:
-                    best_p = p_val
-                    best_f = f_stat
-                    best_lag = lag
-        except Exception:
-            best_lag = None
+        # Flat or too-short series make the lagged OLS fits singular; skip them
+        if otp.std() < MIN_STD or riders.std() < MIN_STD or len(otp) < 2 * MAX_LAG + 5:
             best_p = None
             best_f = None
-
-        results.append({
-            "route_id": route,
-            "best_lag": best_lag,
-            "f_stat": best_f,
-            "p_value": best_p,
-            "p_bonferroni": min(best_p * n_routes, 1.0) if best_p is not None else None,
-            "n_months": len(rdf),
-        })
+        else:
+            # statsmodels expects [y, x] where we test if x Granger-causes y
+            data = np.column_stack([riders, otp])
+            try:
+                res = grangercausalitytests(data, maxlag=MAX_LAG, verbose=False)
+                for lag in range(1, MAX_LAG + 1):
+                    f_stat = res[lag][0]["ssr_ftest"][0]
+                    p_val = res[lag][0]["ssr_ftest"][1]
+                    if p_val < best_p:
+                        best_p = p_val
+                        best_f = f_stat
+                        best_lag = lag
+            except Exception:
+                best_lag = None
+                best_p = None
+                best_f = None
+
+        results["route_id"].append(route)
+        results["best_lag"].append(best_lag)
+        results["f_stat"].append(best_f)
+        results["p_value"].append(best_p)
+        results["p_bonferroni"].append(
+            min(best_p * n_routes, 1.0) if best_p is not None else None
+        )
+        results["n_months"].append(len(rdf))
 
     return pl.DataFrame(results)
 
@@ -204,7 +252,8 @@ def main() -> None:
 
     print("\nLoading data...")
     df = load_data()
-    n_routes = df["route_id"].n_unique()
+    routes = df["route_id"].unique().sort().to_list()
+    n_routes = len(routes)
     print(f"  {len(df):,} route-month observations ({n_routes} routes, {MIN_MONTHS}+ months each)")
 
     print("\nDetrending (subtracting system monthly mean)...")
@@ -221,7 +270,7 @@ def main() -> None:
               f"{row['n_significant']}/{row['n_routes']}")
 
     print("\nRunning Granger causality tests...")
-    gdf = run_granger_tests(df)
+    gdf = run_granger_tests(df, routes)
     valid = gdf.filter(pl.col("p_value").is_not_null())
     n_sig = valid.filter(pl.col("p_value") < 0.05).height
     n_bonf = valid.filter(pl.col("p_bonferroni") < 0.05).height
@@ -7,14 +7,16 @@ import polars as pl
 from scipy import stats
 
 from prt_otp_analysis.common import (
+    cached_query_to_polars,
     classify_bus_route,
     output_dir,
-    query_to_polars,
+    pearson,
     setup_plotting,
 )
 
 HERE = Path(__file__).resolve().parent
 OUT = output_dir(HERE)
+CACHE = HERE / ".cache"
 
 PRE_COVID_START = "2019-01"
 PRE_COVID_END = "2020-02"
@@ -25,14 +27,16 @@ MIN_MONTHS = 6
 
 def load_data() -> pl.DataFrame:
     """Compute pre-COVID and recovery-period averages for both OTP and ridership per route."""
-    paired = query_to_polars("""
+    paired = cached_query_to_polars("""
         SELECT o.route_id, r2.route_name, r2.mode, o.month, o.otp, r.avg_riders
         FROM otp_monthly o
         JOIN ridership_monthly r
             ON o.route_id = r.route_id AND o.month = r.month
             AND r.day_type = 'WEEKDAY'
         JOIN routes r2 ON o.route_id = r2.route_id
-    """)
+        WHERE o.month BETWEEN ? AND ? OR o.month BETWEEN ? AND ?
+    """, CACHE, "paired_windows",
+        (PRE_COVID_START, PRE_COVID_END, RECOVERY_START, RECOVERY_END)).lazy()
 
     # Pre-COVID baseline
     pre = (
@@ -62,7 +66,9 @@ def load_data() -> pl.DataFrame:
         .filter(pl.col("recovery_months") >= MIN_MONTHS)
     )
 
-    df = pre.join(post, on="route_id", how="inner")
+    # SQL already drops months outside both windows; the lazy filters only split the
+    # in-memory rows between them, and one collect runs both aggregations
+    df = pre.join(post, on="route_id", how="inner").collect()
 
     # Compute deltas and ratios
     df = df.with_columns(
@@ -91,12 +97,12 @@ def analyze(df: pl.DataFrame) -> dict:
     rider_r = df["ridership_pct_change"].to_numpy()
 
     # Pearson
-    r_p, p_p = stats.pearsonr(rider_r, otp_d)
+    r_p, p_p = pearson(rider_r, otp_d)
     results["pearson_r"] = r_p
     results["pearson_p"] = p_p
 
-    # Spearman
-    r_s, p_s = stats.spearmanr(rider_r, otp_d)
+    # Spearman (Pearson on average ranks)
+    r_s, p_s = pearson(stats.rankdata(rider_r), stats.rankdata(otp_d))
     results["spearman_r"] = r_s
     results["spearman_p"] = p_s
 
@@ -136,11 +142,11 @@ def make_scatter(df: pl.DataFrame, results: dict) -> None:
         "unknown": "#9ca3af",
     }
 
-    for st in sorted(df["subtype"].unique().to_list()):
-        sdf = df.filter(pl.col("subtype") == st)
+    groups = df.partition_by("subtype", as_dict=True)
+    for (st,), sdf in sorted(groups.items()):
         ax.scatter(
-            sdf["ridership_pct_change"].to_list(),
-            sdf["otp_delta"].to_list(),
+            sdf["ridership_pct_change"].to_numpy(),
+            sdf["otp_delta"].to_numpy(),
             s=40, alpha=0.7,
             color=subtype_colors.get(st, "#9ca3af"),
             edgecolors="white", linewidths=0.5,
@@ -187,18 +193,22 @@ def make_subtype_chart(df: pl.DataFrame) -> None:
     plt = setup_plotting()
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 6))
 
-    subtypes = sorted(df["subtype"].unique().to_list())
     colors = ["#3b82f6", "#22c55e", "#f59e0b", "#ef4444", "#8b5cf6", "#06b6d4", "#9ca3af"]
 
-    # OTP recovery by subtype
+    # One partition per subtype, shared by both panels
     otp_data = []
+    rider_data = []
     labels = []
-    for st in subtypes:
-        vals = df.filter(pl.col("subtype") == st)["otp_delta"].to_list()
-        if len(vals) >= 3:
-            otp_data.append(vals)
-            labels.append(f"{st}\n(n={len(vals)})")
+    groups = df.select("subtype", "otp_delta", "ridership_pct_change").partition_by(
+        "subtype", as_dict=True
+    )
+    for (st,), sdf in sorted(groups.items()):
+        if len(sdf) >= 3:
+            otp_data.append(sdf["otp_delta"].to_numpy())
+            rider_data.append(sdf["ridership_pct_change"].to_numpy())
+            labels.append(f"{st}\n(n={len(sdf)})")
 
+    # OTP recovery by subtype
     bp1 = ax1.boxplot(otp_data, tick_labels=labels, patch_artist=True)
     for patch, color in zip(bp1["boxes"], colors):
         patch.set_facecolor(color)
@@ -208,15 +218,7 @@ def make_subtype_chart(df: pl.DataFrame) -> None:
     ax1.set_title("OTP Recovery by Subtype")
 
     # Ridership recovery by subtype
-    rider_data = []
-    labels2 = []
-    for st in subtypes:
-        vals = df.filter(pl.col("subtype") == st)["ridership_pct_change"].to_list()
-        if len(vals) >= 3:
-            rider_data.append(vals)
-            labels2.append(f"{st}\n(n={len(vals)})")
-
-    bp2 = ax2.boxplot(rider_data, tick_labels=labels2, patch_artist=True)
+    bp2 = ax2.boxplot(rider_data, tick_labels=labels, patch_artist=True)
     for patch, color in zip(bp2["boxes"], colors):
         patch.set_facecolor(color)
         patch.set_alpha(0.6)
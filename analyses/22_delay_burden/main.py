@@ -2,48 +2,52 @@
 
 from pathlib import Path
 
+import numpy as np
 import polars as pl
 from scipy import stats
 
-from prt_otp_analysis.common import output_dir, query_to_polars, setup_plotting
+from prt_otp_analysis.common import (
+    month_axis,
+    output_dir,
+    query_to_polars,
+    setup_plotting,
+)
 
 HERE = Path(__file__).resolve().parent
 OUT = output_dir(HERE)
 
 
-def load_data() -> pl.DataFrame:
-    """Load paired OTP and weekday ridership with day counts."""
-    df = query_to_polars("""
-        SELECT o.route_id, rt.route_name, o.month, o.otp,
-               r.avg_riders, r.day_count
-        FROM otp_monthly o
-        JOIN ridership_monthly r
-            ON o.route_id = r.route_id AND o.month = r.month
-            AND r.day_type = 'WEEKDAY'
-        JOIN routes rt ON o.route_id = rt.route_id
-    """)
-
-    # Compute late rider-trips: riders * weekdays * (1 - OTP)
-    df = df.with_columns(
-        late_rider_trips=(pl.col("avg_riders") * pl.col("day_count") * (1.0 - pl.col("otp"))),
-        total_rider_trips=(pl.col("avg_riders") * pl.col("day_count")),
-    )
+# Weekday route-months with ridership, OTP, and late rider-trips (riders * weekdays * (1 - OTP))
+PAIRED_SQL = """
+    SELECT o.route_id, rt.route_name, o.month, o.otp, r.avg_riders,
+           r.avg_riders * r.day_count * (1.0 - o.otp) AS late_rider_trips,
+           r.avg_riders * r.day_count AS total_rider_trips
+    FROM otp_monthly o
+    JOIN ridership_monthly r
+        ON o.route_id = r.route_id AND o.month = r.month
+        AND r.day_type = 'WEEKDAY'
+    JOIN routes rt ON o.route_id = rt.route_id
+"""
 
-    return df
 
+def route_ranking() -> pl.LazyFrame:
+    """Rank routes by cumulative and average monthly late rider-trips.
 
-def route_ranking(df: pl.DataFrame) -> pl.DataFrame:
-    """Rank routes by cumulative and average monthly late rider-trips."""
+    The SQL aggregate runs eagerly; the returned LazyFrame only defers the rank columns and join.
+    """
     ranking = (
-        df.group_by("route_id", "route_name")
-        .agg(
-            total_late=pl.col("late_rider_trips").sum(),
-            avg_monthly_late=pl.col("late_rider_trips").mean(),
-            total_trips=pl.col("total_rider_trips").sum(),
-            avg_otp=pl.col("otp").mean(),
-            avg_riders=pl.col("avg_riders").mean(),
-            n_months=pl.col("month").count(),
-        )
+        query_to_polars(f"""
+            SELECT route_id, route_name,
+                   SUM(late_rider_trips) AS total_late,
+                   AVG(late_rider_trips) AS avg_monthly_late,
+                   SUM(total_rider_trips) AS total_trips,
+                   AVG(otp) AS avg_otp,
+                   AVG(avg_riders) AS avg_riders,
+                   COUNT(month) AS n_months
+            FROM ({PAIRED_SQL})
+            GROUP BY route_id, route_name
+        """)
+        .lazy()
         .with_columns(
             effective_otp=(1.0 - pl.col("total_late") / pl.col("total_trips")),
         )
@@ -57,52 +61,47 @@ def route_ranking(df: pl.DataFrame) -> pl.DataFrame:
         .with_row_index("otp_rank", offset=1)
         .select("route_id", "otp_rank")
     )
-    ranking = ranking.join(otp_rank, on="route_id")
+    # Keep burden order: main's top-10 table and share read the first ten rows
+    ranking = ranking.join(otp_rank, on="route_id", maintain_order="left")
 
     return ranking
 
 
-def monthly_system(df: pl.DataFrame) -> pl.DataFrame:
-    """Compute system-wide monthly late rider-trips."""
-    return (
-        df.group_by("month")
-        .agg(
-            system_late=pl.col("late_rider_trips").sum(),
-            system_total=pl.col("total_rider_trips").sum(),
-            system_otp=(
-                (pl.col("otp") * pl.col("avg_riders")).sum() / pl.col("avg_riders").sum()
-            ),
-            route_count=pl.col("route_id").n_unique(),
-        )
-        .sort("month")
-    )
+def monthly_system() -> pl.LazyFrame:
+    """Compute system-wide monthly late rider-trips (queried eagerly; only the sort is deferred)."""
+    return query_to_polars(f"""
+        SELECT month,
+               SUM(late_rider_trips) AS system_late,
+               SUM(total_rider_trips) AS system_total,
+               SUM(otp * avg_riders) / SUM(avg_riders) AS system_otp,
+               COUNT(DISTINCT route_id) AS route_count
+        FROM ({PAIRED_SQL})
+        GROUP BY month
+    """).lazy().sort("month")
 
 
-def make_trend_chart(monthly: pl.DataFrame) -> None:
+def make_trend_chart(monthly: pl.DataFrame, axis: dict) -> None:
     """System-wide monthly late rider-trips trend."""
     plt = setup_plotting()
     fig, ax = plt.subplots(figsize=(14, 6))
 
-    months = monthly["month"].to_list()
-    late = [v / 1000 for v in monthly["system_late"].to_list()]  # thousands
-    x = range(len(months))
-    tick_positions = [i for i, m in enumerate(months) if m.endswith("-01")]
-    tick_labels = [months[i][:4] for i in tick_positions]
+    late = monthly["system_late"].to_numpy() / 1000  # thousands
+    x = np.arange(len(axis["months"]))
 
     ax.fill_between(x, late, alpha=0.3, color="#e11d48")
     ax.plot(x, late, color="#e11d48", linewidth=1.5)
 
-    if "2020-03" in months:
-        covid_idx = months.index("2020-03")
+    if "2020-03" in axis["index"]:
+        covid_idx = axis["index"]["2020-03"]
         ax.axvline(covid_idx, color="#ef4444", linestyle=":", alpha=0.7)
-        ax.text(covid_idx + 0.5, max(late) * 0.95, "COVID",
+        ax.text(covid_idx + 0.5, late.max() * 0.95, "COVID",
                 color="#ef4444", fontsize=8, va="top")
 
     ax.set_ylabel("Late Rider-Trips (thousands)")
     ax.set_xlabel("Month")
     ax.set_title("System-Wide Monthly Delay Burden (Weekday Late Rider-Trips)")
-    ax.set_xticks(tick_positions)
-    ax.set_xticklabels(tick_labels)
+    ax.set_xticks(axis["tick_positions"])
+    ax.set_xticklabels(axis["tick_labels"])
 
     fig.tight_layout()
     fig.savefig(OUT / "delay_burden_trend.png", bbox_inches="tight")
@@ -115,10 +114,10 @@ def make_top10_chart(ranking: pl.DataFrame) -> None:
     plt = setup_plotting()
     fig, ax = plt.subplots(figsize=(10, 6))
 
-    top10 = ranking.head(10).sort("total_late")
-    labels = [f"{r['route_id']} - {r['route_name']}" for r in top10.iter_rows(named=True)]
-    values = [v / 1_000_000 for v in top10["total_late"].to_list()]  # millions
-    otp_vals = top10["avg_otp"].to_list()
+    top10 = ranking.top_k(10, by="total_late").sort("total_late")
+    labels = top10.select(label=pl.format("{} - {}", "route_id", "route_name"))["label"].to_list()
+    values = top10["total_late"].to_numpy() / 1_000_000  # millions
+    otp_vals = top10["avg_otp"].to_numpy()
 
     colors = ["#e11d48" if o < 0.65 else "#f59e0b" if o < 0.70 else "#3b82f6" for o in otp_vals]
     bars = ax.barh(range(len(labels)), values, color=colors, edgecolor="white", alpha=0.8)
@@ -153,15 +152,15 @@ def make_rate_vs_burden_chart(ranking: pl.DataFrame) -> None:
     # Diagonal (perfect agreement)
     ax.plot([1, n], [1, n], color="#9ca3af", linestyle="--", linewidth=1, label="Perfect agreement")
 
-    # Label routes that shifted most
-    ranking_with_diff = ranking.with_columns(
-        rank_shift=(pl.col("otp_rank").cast(pl.Int64) - pl.col("burden_rank").cast(pl.Int64)).abs(),
-    )
-    outliers = ranking_with_diff.sort("rank_shift", descending=True).head(8)
-    for row in outliers.iter_rows(named=True):
+    # Label the 8 routes that shifted most (partial selection, no full sort)
+    otp_rank = ranking["otp_rank"].to_numpy().astype(np.int64)
+    burden_rank = ranking["burden_rank"].to_numpy().astype(np.int64)
+    route_ids = ranking["route_id"].to_numpy()
+    shift = np.abs(otp_rank - burden_rank)
+    for i in np.argpartition(shift, -8)[-8:]:
         ax.annotate(
-            row["route_id"],
-            (row["otp_rank"], row["burden_rank"]),
+            route_ids[i],
+            (otp_rank[i], burden_rank[i]),
             fontsize=7, alpha=0.8,
             xytext=(5, 5), textcoords="offset points",
         )
@@ -191,13 +190,9 @@ def main() -> None:
     print("Analysis 22: Passenger-Weighted Delay Burden")
     print("=" * 60)
 
-    print("\nLoading data...")
-    df = load_data()
-    n_routes = df["route_id"].n_unique()
-    print(f"  {len(df):,} route-month observations ({n_routes} routes)")
-
     print("\nRanking routes by delay burden...")
-    ranking = route_ranking(df)
+    ranking, monthly = pl.collect_all([route_ranking(), monthly_system()])
+    print(f"  {ranking['n_months'].sum():,} route-month observations ({ranking.height} routes)")
 
     print("\n  Top 10 routes by cumulative late rider-trips:")
     print(f"  {'Rank':>4} {'Route':<8} {'Name':<32} {'Late trips':>12} {'Avg OTP':>8} {'OTP Rank':>9}")
@@ -224,7 +219,6 @@ def main() -> None:
               f"{row['otp_rank']:>9} {row['burden_rank']:>12} {row['rank_shift']:>+6}")
 
     print("\nComputing system-wide monthly trend...")
-    monthly = monthly_system(df)
     total_late = monthly["system_late"].sum()
     total_trips = monthly["system_total"].sum()
     print(f"  Total late rider-trips (all time): {total_late:,.0f}")
@@ -242,7 +236,7 @@ def main() -> None:
     print(f"  {OUT / 'delay_burden_monthly.csv'}")
 
     print("\nGenerating charts...")
-    make_trend_chart(monthly)
+    make_trend_chart(monthly, month_axis(monthly["month"].to_numpy()))
     make_top10_chart(ranking)
     make_rate_vs_burden_chart(ranking)
 
@@ -1,23 +1,32 @@
 """Analysis 23: Compare OTP and ridership across PRT garages to surface operational differences."""
 
-import math
+import sqlite3
 from pathlib import Path
 
 import numpy as np
 import polars as pl
-from scipy import stats
-
-from prt_otp_analysis.common import output_dir, query_to_polars, setup_plotting
+from scipy import linalg, stats
+
+from prt_otp_analysis.common import (
+    cached_frame,
+    db_session,
+    month_axis,
+    output_dir,
+    query_to_polars,
+    setup_plotting,
+    significance_stars,
+)
 
 HERE = Path(__file__).resolve().parent
 OUT = output_dir(HERE)
+CACHE = HERE / ".cache"
 
 MIN_MONTHS = 12
 
 
-def load_data() -> pl.DataFrame:
-    """Load OTP joined with garage assignment and ridership."""
-    df = query_to_polars("""
+# Weekday route-months with a garage assignment, limited to routes with MIN_MONTHS+ months
+PAIRED_CTE = """
+    WITH paired AS (
         SELECT o.route_id, o.month, o.otp,
                r.avg_riders, r.current_garage,
                rt.mode
@@ -27,30 +36,30 @@ def load_data() -> pl.DataFrame:
             AND r.day_type = 'WEEKDAY'
         JOIN routes rt ON o.route_id = rt.route_id
         WHERE r.current_garage IS NOT NULL
-    """)
-
-    # Filter to routes with enough data
-    route_counts = df.group_by("route_id").agg(pl.col("month").count().alias("n"))
-    keep = route_counts.filter(pl.col("n") >= MIN_MONTHS)["route_id"].to_list()
-    df = df.filter(pl.col("route_id").is_in(keep))
-
-    return df
-
-
-def route_level_summary(df: pl.DataFrame) -> pl.DataFrame:
-    """Compute route-level average OTP and ridership with garage assignment."""
-    return (
-        df.group_by("route_id", "current_garage", "mode")
-        .agg(
-            avg_otp=pl.col("otp").mean(),
-            avg_riders=pl.col("avg_riders").mean(),
-            n_months=pl.col("month").count(),
+    ),
+    kept AS (
+        SELECT * FROM paired
+        WHERE route_id IN (
+            SELECT route_id FROM paired GROUP BY route_id HAVING COUNT(month) >= ?
         )
-        .sort("current_garage", "avg_otp")
     )
+"""
 
 
-def garage_summary(route_df: pl.DataFrame) -> pl.DataFrame:
+def route_level_summary(conn: sqlite3.Connection) -> pl.LazyFrame:
+    """Compute route-level average OTP and ridership with garage assignment."""
+    return query_to_polars(f"""
+        {PAIRED_CTE}
+        SELECT route_id, current_garage, mode,
+               AVG(otp) AS avg_otp,
+               AVG(avg_riders) AS avg_riders,
+               COUNT(month) AS n_months
+        FROM kept
+        GROUP BY route_id, current_garage, mode
+    """, (MIN_MONTHS,), conn).lazy().sort("current_garage", "avg_otp")
+
+
+def garage_summary(route_df: pl.LazyFrame) -> pl.LazyFrame:
     """Compute garage-level summary statistics."""
     return (
         route_df.group_by("current_garage")
@@ -70,62 +79,46 @@ def garage_summary(route_df: pl.DataFrame) -> pl.DataFrame:
     )
 
 
-def monthly_by_garage(df: pl.DataFrame) -> pl.DataFrame:
+def monthly_by_garage(conn: sqlite3.Connection) -> pl.LazyFrame:
     """Compute monthly ridership-weighted OTP per garage."""
-    return (
-        df.group_by("current_garage", "month")
-        .agg(
-            weighted_otp=(
-                (pl.col("otp") * pl.col("avg_riders")).sum() / pl.col("avg_riders").sum()
-            ),
-            unweighted_otp=pl.col("otp").mean(),
-            total_riders=pl.col("avg_riders").sum(),
-            n_routes=pl.col("route_id").n_unique(),
-        )
-        .sort("current_garage", "month")
-    )
+    return query_to_polars(f"""
+        {PAIRED_CTE}
+        SELECT current_garage, month,
+               SUM(otp * avg_riders) / SUM(avg_riders) AS weighted_otp,
+               AVG(otp) AS unweighted_otp,
+               SUM(avg_riders) AS total_riders,
+               COUNT(DISTINCT route_id) AS n_routes
+        FROM kept
+        GROUP BY current_garage, month
+    """, (MIN_MONTHS,), conn).lazy().sort("current_garage", "month")
 
 
 def statistical_tests(route_df: pl.DataFrame) -> dict:
     """Run Kruskal-Wallis and pairwise Mann-Whitney tests across garages."""
     results = {}
 
-    # All routes
-    garages = sorted(route_df["current_garage"].unique().to_list())
-    groups = []
-    garage_names = []
-    for g in garages:
-        vals = route_df.filter(pl.col("current_garage") == g)["avg_otp"].to_list()
-        if len(vals) >= 3:
-            groups.append(vals)
-            garage_names.append(g)
-
-    if len(groups) >= 2:
-        h, p = stats.kruskal(*groups)
-        results["kruskal_h_all"] = h
-        results["kruskal_p_all"] = p
-        results["garages_tested_all"] = garage_names
-
-    # Bus-only
-    bus_df = route_df.filter(pl.col("mode") == "BUS")
-    bus_groups = []
-    bus_names = []
-    for g in garages:
-        vals = bus_df.filter(pl.col("current_garage") == g)["avg_otp"].to_list()
-        if len(vals) >= 3:
-            bus_groups.append(vals)
-            bus_names.append(g)
-
-    if len(bus_groups) >= 2:
-        h, p = stats.kruskal(*bus_groups)
-        results["kruskal_h_bus"] = h
-        results["kruskal_p_bus"] = p
-        results["garages_tested_bus"] = bus_names
+    for suffix, frame in [
+        ("all", route_df),
+        ("bus", route_df.filter(pl.col("mode") == "BUS")),
+    ]:
+        parts = frame.partition_by("current_garage", as_dict=True)
+        groups = []
+        garage_names = []
+        for (g,), part in sorted(parts.items()):
+            if part.height >= 3:
+                groups.append(part["avg_otp"].to_numpy())
+                garage_names.append(g)
+
+        if len(groups) >= 2:
+            h, p = stats.kruskal(*groups)
+            results[f"kruskal_h_{suffix}"] = h
+            results[f"kruskal_p_{suffix}"] = p
+            results[f"garages_tested_{suffix}"] = garage_names
 
     return results
 
 
-def make_trend_chart(monthly: pl.DataFrame) -> None:
+def make_trend_chart(monthly: pl.DataFrame, axis: dict) -> None:
     """Plot monthly ridership-weighted OTP by garage."""
     plt = setup_plotting()
     fig, ax = plt.subplots(figsize=(14, 6))
@@ -139,29 +132,23 @@ def make_trend_chart(monthly: pl.DataFrame) -> None:
         "Incline": "#9ca3af",
     }
 
-    # Build x-axis from all months
-    all_months = sorted(monthly["month"].unique().to_list())
-    month_to_x = {m: i for i, m in enumerate(all_months)}
-    tick_positions = [i for i, m in enumerate(all_months) if m.endswith("-01")]
-    tick_labels = [all_months[i][:4] for i in tick_positions]
-
-    for garage in sorted(monthly["current_garage"].unique().to_list()):
-        gdf = monthly.filter(pl.col("current_garage") == garage).sort("month")
+    parts = monthly.sort("month").partition_by("current_garage", as_dict=True)
+    for (garage,), gdf in sorted(parts.items()):
         months = gdf["month"].to_list()
-        x = [month_to_x[m] for m in months]
+        x = [axis["index"][m] for m in months]
         y = gdf["weighted_otp"].to_list()
         color = garage_colors.get(garage, "#9ca3af")
         ax.plot(x, y, color=color, linewidth=1.5, label=garage, alpha=0.8)
 
-    if "2020-03" in all_months:
-        covid_idx = month_to_x["2020-03"]
+    if "2020-03" in axis["index"]:
+        covid_idx = axis["index"]["2020-03"]
         ax.axvline(covid_idx, color="#ef4444", linestyle=":", alpha=0.5)
 
     ax.set_ylabel("Ridership-Weighted OTP")
     ax.set_xlabel("Month")
     ax.set_title("Monthly OTP by Garage (Ridership-Weighted)")
-    ax.set_xticks(tick_positions)
-    ax.set_xticklabels(tick_labels)
+    ax.set_xticks(axis["tick_positions"])
+    ax.set_xticklabels(axis["tick_labels"])
     ax.legend(loc="lower left", fontsize=8)
     ax.set_ylim(0.45, 0.90)
 
@@ -182,14 +169,12 @@ def make_boxplot(route_df: pl.DataFrame) -> None:
         (ax1, "All Routes", route_df),
         (ax2, "Bus Only", route_df.filter(pl.col("mode") == "BUS")),
     ]:
-        garages = sorted(filt["current_garage"].unique().to_list())
         data = []
         labels = []
-        for g in garages:
-            vals = filt.filter(pl.col("current_garage") == g)["avg_otp"].to_list()
-            if len(vals) >= 2:
-                data.append(vals)
-                labels.append(f"{g}\n(n={len(vals)})")
+        for (g,), part in sorted(filt.partition_by("current_garage", as_dict=True).items()):
+            if part.height >= 2:
+                data.append(part["avg_otp"].to_numpy())
+                labels.append(f"{g}\n(n={part.height})")
 
         bp = ax.boxplot(data, tick_labels=labels, patch_artist=True)
         for patch, color in zip(bp["boxes"], garage_colors):
@@ -206,34 +191,62 @@ def make_boxplot(route_df: pl.DataFrame) -> None:
     print(f"  Chart saved to {OUT / 'garage_boxplot.png'}")
 
 
-def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    """Return the great-circle distance in km between two lat/lon points."""
+def compute_spans(stops_by_route: pl.DataFrame) -> pl.DataFrame:
+    """Return each route's max pairwise haversine distance (km) among its stops.
+
+    Works on all routes at once: a per-route self-join of stops evaluated with
+    Polars expressions, then a grouped max. The plan runs on the streaming engine
+    so the O(n^2) stop pairs are reduced batch by batch rather than materialized.
+    """
     R = 6371.0
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = (math.sin(dlat / 2) ** 2
-         + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2))
-         * math.sin(dlon / 2) ** 2)
-    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-
-def compute_span(lats: list[float], lons: list[float]) -> float:
-    """Return the max pairwise haversine distance (km) among a set of points."""
-    max_dist = 0.0
-    n = len(lats)
-    for i in range(n):
-        for j in range(i + 1, n):
-            d = haversine_km(lats[i], lons[i], lats[j], lons[j])
-            if d > max_dist:
-                max_dist = d
-    return max_dist
-
-
-def fit_ols(y: np.ndarray, X_raw: np.ndarray, feature_names: list[str]) -> dict:
-    """Fit OLS regression and return results dict."""
-    n, k = X_raw.shape
-    X = np.column_stack([np.ones(n), X_raw])
-    beta, _, _, _ = np.linalg.lstsq(X, y, rcond=None)
+    pts = stops_by_route.lazy().with_columns(
+        pl.col("lat").radians(),
+        pl.col("lon").radians(),
+        idx=pl.int_range(pl.len()).over("route_id"),
+    )
+    pairs = pts.join(pts, on="route_id", suffix="_b").filter(pl.col("idx") < pl.col("idx_b"))
+    a = (
+        ((pl.col("lat_b") - pl.col("lat")) / 2).sin() ** 2
+        + pl.col("lat").cos() * pl.col("lat_b").cos()
+        * ((pl.col("lon_b") - pl.col("lon")) / 2).sin() ** 2
+    )
+    spans = pairs.group_by("route_id").agg(span_km=(2 * R * a.clip(0.0, 1.0).sqrt().arcsin()).max())
+
+    # Single-stop routes have no pairs; their span is zero
+    return (
+        stops_by_route.lazy().select("route_id").unique()
+        .join(spans, on="route_id", how="left")
+        .with_columns(pl.col("span_km").fill_null(0.0))
+        .sort("route_id")
+        .collect(engine="streaming")
+    )
+
+
+def design_matrix(df: pl.DataFrame, features: list[str]) -> np.ndarray:
+    """Return an (n, k+1) Fortran-ordered design matrix with a leading intercept column."""
+    X = np.empty((df.height, len(features) + 1), dtype=np.float64, order="F")
+    X[:, 0] = 1.0
+    # One Polars -> NumPy conversion for all feature columns
+    X[:, 1:] = df.select(pl.col(features).cast(pl.Float64)).to_numpy()
+    return X
+
+
+def fit_ols(y: np.ndarray, X: np.ndarray, feature_names: list[str]) -> dict:
+    """Fit OLS regression on a design matrix that already includes the intercept column."""
+    n, k = X.shape[0], X.shape[1] - 1
+    # One Cholesky factorization of X'X and one solve against [X'y | I] give both
+    # beta and the covariance; inputs come from the DB, so skip the finiteness scans
+    XtX = X.T @ X
+    try:
+        cho = linalg.cho_factor(XtX, check_finite=False)
+        rhs = np.empty((k + 1, k + 2))
+        rhs[:, 0] = X.T @ y
+        rhs[:, 1:] = np.eye(k + 1)
+        sol = linalg.cho_solve(cho, rhs, check_finite=False)
+        beta, XtX_inv = sol[:, 0], sol[:, 1:]
+    except linalg.LinAlgError:
+        XtX_inv = np.linalg.pinv(XtX)
+        beta = XtX_inv @ (X.T @ y)
     y_hat = X @ beta
     residuals = y - y_hat
     ss_res = np.sum(residuals ** 2)
@@ -241,46 +254,52 @@ def fit_ols(y: np.ndarray, X_raw: np.ndarray, feature_names: list[str]) -> dict:
     r_squared = 1 - ss_res / ss_tot
     adj_r_squared = 1 - (1 - r_squared) * (n - 1) / (n - k - 1)
     mse = ss_res / (n - k - 1)
-    XtX_inv = np.linalg.pinv(X.T @ X)
     se = np.sqrt(np.diag(XtX_inv) * mse)
     t_vals = beta / se
-    p_vals = [2 * (1 - stats.t.cdf(abs(t), df=n - k - 1)) for t in t_vals]
+    p_vals = 2.0 * stats.t.sf(np.abs(t_vals), df=n - k - 1)
     return {
         "r_squared": r_squared,
         "adj_r_squared": adj_r_squared,
+        "ss_res": float(ss_res),
         "n": n, "k": k,
         "features": ["intercept"] + feature_names,
         "coefficients": beta.tolist(),
         "std_errors": se.tolist(),
-        "p_values": p_vals,
+        "p_values": p_vals.tolist(),
     }
 
 
-def load_structural_features() -> pl.DataFrame:
-    """Load route-level structural features (stop count, span) for the controlled model."""
-    stop_counts = query_to_polars("""
+STRUCT_SQL = """
+    SELECT rs.route_id, sc.stop_count, s.lat, s.lon
+    FROM route_stops rs
+    JOIN (
         SELECT route_id, COUNT(DISTINCT stop_id) AS stop_count
         FROM route_stops GROUP BY route_id
-    """)
-    stops_by_route = query_to_polars("""
-        SELECT rs.route_id, s.lat, s.lon
-        FROM route_stops rs
-        JOIN stops s ON rs.stop_id = s.stop_id
-        WHERE s.lat IS NOT NULL AND s.lon IS NOT NULL
-    """)
-    spans = []
-    for route_id in stops_by_route["route_id"].unique().sort().to_list():
-        subset = stops_by_route.filter(pl.col("route_id") == route_id)
-        span_km = compute_span(subset["lat"].to_list(), subset["lon"].to_list())
-        spans.append({"route_id": route_id, "span_km": span_km})
-    span_df = pl.DataFrame(spans)
+    ) sc ON rs.route_id = sc.route_id
+    JOIN stops s ON rs.stop_id = s.stop_id
+    WHERE s.lat IS NOT NULL AND s.lon IS NOT NULL
+"""
+
+
+def build_structural_features(conn: sqlite3.Connection) -> pl.DataFrame:
+    """Compute route-level structural features (stop count, span) from the stop tables."""
+    # One query: every located stop per route, tagged with the route's total stop count
+    stops_by_route = query_to_polars(STRUCT_SQL, conn=conn)
+    stop_counts = stops_by_route.group_by("route_id").agg(pl.col("stop_count").first())
+    span_df = compute_spans(stops_by_route.select("route_id", "lat", "lon"))
 
     return stop_counts.join(span_df, on="route_id", how="inner")
 
 
-def controlled_garage_test(route_df: pl.DataFrame) -> dict:
+def load_structural_features(conn: sqlite3.Connection) -> pl.DataFrame:
+    """Load route-level structural features, reusing the cached copy until prt.db changes."""
+    return cached_frame(
+        CACHE, "structural_features", STRUCT_SQL, lambda: build_structural_features(conn)
+    )
+
+
+def controlled_garage_test(route_df: pl.DataFrame, struct: pl.DataFrame) -> dict:
     """Fit OLS models with and without garage dummies, controlling for stop count, span, and mode."""
-    struct = load_structural_features()
     df = route_df.join(struct, on="route_id", how="inner")
     df = df.with_columns(
         pl.when(pl.col("mode") == "RAIL").then(1.0).otherwise(0.0).alias("is_rail"),
@@ -291,23 +310,25 @@ def controlled_garage_test(route_df: pl.DataFrame) -> dict:
 
     # Reference garage = East Liberty (largest, excluded from dummies)
     bus_garages = sorted(set(bus_df["current_garage"].to_list()) - {"East Liberty"})
-    for g in bus_garages:
-        col_name = f"garage_{g.replace(' ', '_')}"
-        bus_df = bus_df.with_columns(
-            pl.when(pl.col("current_garage") == g).then(1.0).otherwise(0.0).alias(col_name),
-        )
+    dummies = (
+        bus_df.select("current_garage")
+        .to_dummies(separator="=")
+        .rename(lambda c: f"garage_{c.split('=', 1)[1].replace(' ', '_')}")
+        .drop("garage_East_Liberty", strict=False)
+    )
+    bus_df = bus_df.hstack(dummies)
 
     y = bus_df["avg_otp"].to_numpy()
 
     # Model 1: structural only (stop_count, span_km)
     base_features = ["stop_count", "span_km"]
-    X_base = np.column_stack([bus_df[f].to_numpy().astype(float) for f in base_features])
+    X_base = design_matrix(bus_df, base_features)
     base_results = fit_ols(y, X_base, base_features)
 
     # Model 2: structural + garage dummies
     garage_cols = [f"garage_{g.replace(' ', '_')}" for g in bus_garages]
     full_features = base_features + garage_cols
-    X_full = np.column_stack([bus_df[f].to_numpy().astype(float) for f in full_features])
+    X_full = design_matrix(bus_df, full_features)
     full_results = fit_ols(y, X_full, full_features)
 
     # F-test for garage dummies (nested model comparison)
@@ -315,8 +336,8 @@ def controlled_garage_test(route_df: pl.DataFrame) -> dict:
     k_base = len(base_features)
     k_full = len(full_features)
     k_diff = k_full - k_base
-    ss_res_base = np.sum((y - np.mean(y)) ** 2) * (1 - base_results["r_squared"])
-    ss_res_full = np.sum((y - np.mean(y)) ** 2) * (1 - full_results["r_squared"])
+    ss_res_base = base_results["ss_res"]
+    ss_res_full = full_results["ss_res"]
     f_stat = ((ss_res_base - ss_res_full) / k_diff) / (ss_res_full / (n - k_full - 1))
     f_p = 1 - stats.f.cdf(f_stat, k_diff, n - k_full - 1)
 
@@ -338,14 +359,17 @@ def main() -> None:
     print("Analysis 23: Garage-Level Performance")
     print("=" * 60)
 
-    print("\nLoading data...")
-    df = load_data()
-    n_routes = df["route_id"].n_unique()
-    print(f"  {len(df):,} route-month observations ({n_routes} routes)")
-
     print("\nComputing route-level summaries...")
-    route_df = route_level_summary(df)
-    gsummary = garage_summary(route_df)
+    # All three queries share one connection
+    with db_session() as conn:
+        route_lf = route_level_summary(conn)
+        monthly_lf = monthly_by_garage(conn)
+        struct = load_structural_features(conn)
+    route_df, gsummary, monthly = pl.collect_all(
+        [route_lf, garage_summary(route_lf), monthly_lf]
+    )
+    n_routes = route_df["route_id"].n_unique()
+    print(f"  {route_df['n_months'].sum():,} route-month observations ({n_routes} routes)")
 
     print("\n  Garage summary:")
     print(f"  {'Garage':<22} {'Routes':>6} {'Mean OTP':>9} {'Wt OTP':>9} {'Riders':>10}")
@@ -368,7 +392,7 @@ def main() -> None:
         print(f"    Garages tested: {test_results['garages_tested_bus']}")
 
     print("\nControlled analysis (OLS with structural controls)...")
-    ctrl = controlled_garage_test(route_df)
+    ctrl = controlled_garage_test(route_df, struct)
     base = ctrl["base_results"]
     full = ctrl["full_results"]
     print(f"\n  Bus-only models (n = {ctrl['n_bus']}, reference garage = East Liberty):")
@@ -387,15 +411,12 @@ def main() -> None:
     # Print garage coefficients
     print(f"\n  {'Feature':<25s} {'Coeff':>10s} {'Std Err':>10s} {'p-value':>10s}")
     print(f"  {'-'*55}")
+    stars = significance_stars(full["p_values"])
     for i, feat in enumerate(full["features"]):
         coeff = full["coefficients"][i]
         se = full["std_errors"][i]
         p = full["p_values"][i]
-        sig = "***" if p < 0.001 else "**" if p < 0.01 else "*" if p < 0.05 else ""
-        print(f"  {feat:<25s} {coeff:>10.6f} {se:>10.6f} {p:>10.4f} {sig}")
-
-    print("\nComputing monthly trends...")
-    monthly = monthly_by_garage(df)
+        print(f"  {feat:<25s} {coeff:>10.6f} {se:>10.6f} {p:>10.4f} {stars[i]}")
 
     print("\nSaving CSVs...")
     gsummary.write_csv(OUT / "garage_summary.csv")
@@ -406,7 +427,7 @@ def main() -> None:
     print(f"  {OUT / 'garage_monthly.csv'}")
 
     print("\nGenerating charts...")
-    make_trend_chart(monthly)
+    make_trend_chart(monthly, month_axis(monthly["month"].unique().sort().to_numpy()))
     make_boxplot(route_df)
 
     print("\nDone.")
@@ -2,46 +2,52 @@
 
 from pathlib import Path
 
+import numpy as np
 import polars as pl
 from scipy import stats
 
-from prt_otp_analysis.common import output_dir, query_to_polars, setup_plotting
+from prt_otp_analysis.common import (
+    cached_query_to_polars,
+    corr_p_value,
+    month_axis,
+    output_dir,
+    setup_plotting,
+)
 
 HERE = Path(__file__).resolve().parent
 OUT = output_dir(HERE)
+CACHE = HERE / ".cache"
 
 
 def load_ridership() -> pl.DataFrame:
     """Load all ridership data across day types."""
-    return query_to_polars("""
+    return cached_query_to_polars("""
         SELECT route_id, month, day_type, avg_riders, day_count
         FROM ridership_monthly
         WHERE avg_riders IS NOT NULL AND day_count IS NOT NULL
-    """)
+    """, CACHE, "ridership")
 
 
 def load_otp() -> pl.DataFrame:
     """Load OTP data for correlation analysis."""
-    return query_to_polars("""
+    return cached_query_to_polars("""
         SELECT route_id, month, otp
         FROM otp_monthly
-    """)
+    """, CACHE, "otp")
 
 
-def system_monthly(df: pl.DataFrame) -> pl.DataFrame:
-    """Compute system-wide total monthly riders by day type."""
-    return (
-        df.with_columns(
-            (pl.col("avg_riders") * pl.col("day_count")).alias("total_riders"),
-        )
-        .group_by("month", "day_type")
-        .agg(
-            total_riders=pl.col("total_riders").sum(),
-            avg_riders_sum=pl.col("avg_riders").sum(),
-            n_routes=pl.col("route_id").n_unique(),
-        )
-        .sort("month", "day_type")
-    )
+def system_monthly() -> pl.DataFrame:
+    """Compute system-wide total monthly riders by day type (aggregated in SQL)."""
+    return cached_query_to_polars("""
+        SELECT month, day_type,
+               SUM(avg_riders * day_count) AS total_riders,
+               SUM(avg_riders) AS avg_riders_sum,
+               COUNT(DISTINCT route_id) AS n_routes
+        FROM ridership_monthly
+        WHERE avg_riders IS NOT NULL AND day_count IS NOT NULL
+        GROUP BY month, day_type
+        ORDER BY month, day_type
+    """, CACHE, "system_monthly")
 
 
 def index_to_baseline(monthly: pl.DataFrame, baseline_month: str = "2019-01") -> pl.DataFrame:
@@ -51,7 +57,7 @@ def index_to_baseline(monthly: pl.DataFrame, baseline_month: str = "2019-01") ->
         .select("day_type", pl.col("total_riders").alias("baseline_riders"))
     )
     return (
-        monthly.join(baseline, on="day_type", how="left")
+        monthly.join(baseline, on="day_type", how="left", maintain_order="left")
         .with_columns(
             (pl.col("total_riders") / pl.col("baseline_riders") * 100).alias("indexed"),
         )
@@ -60,13 +66,15 @@ def index_to_baseline(monthly: pl.DataFrame, baseline_month: str = "2019-01") ->
 
 def weekend_share_monthly(monthly: pl.DataFrame) -> pl.DataFrame:
     """Compute weekend ridership share per month."""
+    pivoted = monthly.pivot(
+        on="day_type", index="month", values="total_riders", aggregate_function="sum",
+    ).rename({"WEEKDAY": "weekday", "SAT.": "saturday", "SUN.": "sunday"}, strict=False)
+    # A day type with no rows in the data gets no pivot column; count it as 0 riders
+    zero = pl.lit(0, dtype=monthly.schema["total_riders"])
+    missing = [c for c in ("weekday", "saturday", "sunday") if c not in pivoted.columns]
     pivoted = (
-        monthly.group_by("month")
-        .agg(
-            weekday=pl.col("total_riders").filter(pl.col("day_type") == "WEEKDAY").sum(),
-            saturday=pl.col("total_riders").filter(pl.col("day_type") == "SAT.").sum(),
-            sunday=pl.col("total_riders").filter(pl.col("day_type") == "SUN.").sum(),
-        )
+        pivoted.with_columns(zero.alias(c) for c in missing)
+        .fill_null(0)
         .with_columns(
             total=pl.col("weekday") + pl.col("saturday") + pl.col("sunday"),
         )
@@ -80,29 +88,46 @@ def weekend_share_monthly(monthly: pl.DataFrame) -> pl.DataFrame:
     return pivoted
 
 
-def route_weekend_share(df: pl.DataFrame) -> pl.DataFrame:
+def route_weekend_share() -> pl.DataFrame:
     """Compute per-route average weekend-to-weekday ridership ratio.
 
     For each route-month where all three day types are present, compute:
       weekend_ratio = (SAT avg_riders + SUN avg_riders) / WEEKDAY avg_riders
     Then average across months.
     """
-    # Pivot to get all three day types per route-month
-    wide = (
-        df.pivot(on="day_type", index=["route_id", "month"], values="avg_riders")
-    )
-    # Only keep rows where all three day types are present
-    required = ["WEEKDAY", "SAT.", "SUN."]
-    for col in required:
-        if col not in wide.columns:
-            return pl.DataFrame()
-    wide = wide.drop_nulls(subset=required)
-    wide = wide.filter(pl.col("WEEKDAY") > 0)
-
-    wide = wide.with_columns(
-        weekend_ratio=(
-            (pl.col("SAT.") + pl.col("SUN.")) / pl.col("WEEKDAY")
+    # Only route-months with all three day types, on routes with 6+ such months
+    df = cached_query_to_polars("""
+        WITH complete AS (
+            SELECT route_id, month
+            FROM ridership_monthly
+            WHERE avg_riders IS NOT NULL AND day_count IS NOT NULL
+            GROUP BY route_id, month
+            HAVING COUNT(DISTINCT day_type) = 3
         ),
+        kept AS (
+            SELECT route_id FROM complete GROUP BY route_id HAVING COUNT(month) >= 6
+        )
+        SELECT r.route_id, r.month, r.day_type, r.avg_riders
+        FROM ridership_monthly r
+        JOIN complete c ON r.route_id = c.route_id AND r.month = c.month
+        WHERE r.route_id IN (SELECT route_id FROM kept)
+    """, CACHE, "route_daytypes")
+    if len(df) == 0:
+        return pl.DataFrame()
+
+    # One row per route-month with each day type's riders as a conditional sum
+    # (the query already guarantees all three day types are present)
+    riders = pl.col("avg_riders")
+    day_type = pl.col("day_type")
+    wide = (
+        df.group_by("route_id", "month")
+        .agg(
+            weekday=pl.when(day_type == "WEEKDAY").then(riders).otherwise(0.0).sum(),
+            sat=pl.when(day_type == "SAT.").then(riders).otherwise(0.0).sum(),
+            sun=pl.when(day_type == "SUN.").then(riders).otherwise(0.0).sum(),
+        )
+        .filter(pl.col("weekday") > 0)
+        .with_columns(weekend_ratio=(pl.col("sat") + pl.col("sun")) / pl.col("weekday"))
     )
 
     route_avg = (
@@ -129,18 +154,18 @@ def correlate_weekend_otp(route_wkend: pl.DataFrame, otp_df: pl.DataFrame) -> di
     if len(merged) < 10:
         return {"n": len(merged), "error": "too few routes"}
 
-    x = merged["avg_weekend_ratio"].to_list()
-    y = merged["avg_otp"].to_list()
-
-    r_pearson, p_pearson = stats.pearsonr(x, y)
-    r_spearman, p_spearman = stats.spearmanr(x, y)
+    # Both coefficients in one Polars select (Spearman = Pearson on ranks)
+    r_pearson, r_spearman = merged.select(
+        pl.corr("avg_weekend_ratio", "avg_otp").alias("pearson"),
+        pl.corr(pl.col("avg_weekend_ratio").rank(), pl.col("avg_otp").rank()).alias("spearman"),
+    ).row(0)
 
     return {
         "n": len(merged),
         "r_pearson": r_pearson,
-        "p_pearson": p_pearson,
+        "p_pearson": corr_p_value(r_pearson, len(merged)),
         "r_spearman": r_spearman,
-        "p_spearman": p_spearman,
+        "p_spearman": corr_p_value(r_spearman, len(merged)),
         "merged": merged,
     }
 
@@ -156,30 +181,29 @@ def make_trend_chart(monthly_idx: pl.DataFrame) -> None:
         "SUN.": {"color": "#e11d48", "label": "Sunday/Holiday"},
     }
 
-    all_months = sorted(monthly_idx["month"].unique().to_list())
-    month_to_x = {m: i for i, m in enumerate(all_months)}
-    tick_positions = [i for i, m in enumerate(all_months) if m.endswith("-01")]
-    tick_labels = [all_months[i][:4] for i in tick_positions]
+    axis = month_axis(monthly_idx["month"].unique().sort().to_numpy())
+    # x position = dense rank of the month among all months
+    monthly_idx = monthly_idx.with_columns(x=pl.col("month").rank("dense").cast(pl.Int32) - 1)
 
     for day_type, style in day_type_styles.items():
         sub = monthly_idx.filter(pl.col("day_type") == day_type).sort("month")
         if len(sub) == 0:
             continue
-        x = [month_to_x[m] for m in sub["month"].to_list()]
-        y = sub["indexed"].to_list()
+        x = sub["x"].to_numpy()
+        y = sub["indexed"].to_numpy()
         ax.plot(x, y, color=style["color"], linewidth=1.8, label=style["label"], alpha=0.85)
 
     ax.axhline(100, color="gray", linestyle="--", alpha=0.4, linewidth=0.8)
 
-    if "2020-03" in all_months:
-        covid_idx = month_to_x["2020-03"]
+    if "2020-03" in axis["index"]:
+        covid_idx = axis["index"]["2020-03"]
         ax.axvline(covid_idx, color="#ef4444", linestyle=":", alpha=0.5, label="COVID (Mar 2020)")
 
     ax.set_ylabel("Indexed Ridership (Jan 2019 = 100)")
     ax.set_xlabel("Month")
     ax.set_title("System-Wide Ridership by Day Type (Indexed to Jan 2019)")
-    ax.set_xticks(tick_positions)
-    ax.set_xticklabels(tick_labels)
+    ax.set_xticks(axis["tick_positions"])
+    ax.set_xticklabels(axis["tick_labels"])
     ax.legend(loc="upper right", fontsize=9)
 
     fig.tight_layout()
@@ -193,29 +217,26 @@ def make_weekend_share_chart(wk_share: pl.DataFrame) -> None:
     plt = setup_plotting()
     fig, ax = plt.subplots(figsize=(12, 5))
 
-    all_months = sorted(wk_share["month"].to_list())
-    month_to_x = {m: i for i, m in enumerate(all_months)}
-    tick_positions = [i for i, m in enumerate(all_months) if m.endswith("-01")]
-    tick_labels = [all_months[i][:4] for i in tick_positions]
-
-    x = [month_to_x[m] for m in wk_share["month"].to_list()]
-    y_total = wk_share["weekend_share"].to_list()
-    y_sat = wk_share["sat_share"].to_list()
-    y_sun = wk_share["sun_share"].to_list()
+    # One row per month, already sorted: x position = row index
+    axis = month_axis(wk_share["month"].to_numpy())
+    x = np.arange(len(wk_share))
+    y_total = wk_share["weekend_share"].to_numpy()
+    y_sat = wk_share["sat_share"].to_numpy()
+    y_sun = wk_share["sun_share"].to_numpy()
 
     ax.plot(x, y_total, color="#2563eb", linewidth=2.0, label="Weekend (Sat + Sun)", alpha=0.85)
     ax.plot(x, y_sat, color="#16a34a", linewidth=1.2, label="Saturday only", alpha=0.7, linestyle="--")
     ax.plot(x, y_sun, color="#e11d48", linewidth=1.2, label="Sunday only", alpha=0.7, linestyle="--")
 
-    if "2020-03" in all_months:
-        covid_idx = month_to_x["2020-03"]
+    if "2020-03" in axis["index"]:
+        covid_idx = axis["index"]["2020-03"]
         ax.axvline(covid_idx, color="#ef4444", linestyle=":", alpha=0.5)
 
     ax.set_ylabel("Share of Total Ridership")
     ax.set_xlabel("Month")
     ax.set_title("Weekend Ridership Share Over Time")
-    ax.set_xticks(tick_positions)
-    ax.set_xticklabels(tick_labels)
+    ax.set_xticks(axis["tick_positions"])
+    ax.set_xticklabels(axis["tick_labels"])
     ax.legend(loc="upper left", fontsize=9)
     ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda v, _: f"{v:.0%}"))
 
@@ -230,15 +251,15 @@ def make_scatter_chart(merged: pl.DataFrame) -> None:
     plt = setup_plotting()
     fig, ax = plt.subplots(figsize=(8, 6))
 
-    x = merged["avg_weekend_ratio"].to_list()
-    y = merged["avg_otp"].to_list()
+    x = merged["avg_weekend_ratio"].to_numpy()
+    y = merged["avg_otp"].to_numpy()
 
     ax.scatter(x, y, alpha=0.5, s=30, color="#2563eb", edgecolors="white", linewidth=0.5)
 
     # Trend line
     slope, intercept, _, _, _ = stats.linregress(x, y)
-    x_line = [min(x), max(x)]
-    y_line = [slope * xi + intercept for xi in x_line]
+    x_line = np.array([x.min(), x.max()])
+    y_line = np.polyval([slope, intercept], x_line)
     ax.plot(x_line, y_line, color="#e11d48", linewidth=1.5, linestyle="--", alpha=0.7)
 
     ax.set_xlabel("Average Weekend-to-Weekday Ridership Ratio")
@@ -260,13 +281,20 @@ def main() -> None:
 
     print("\nLoading ridership data...")
     ride_df = load_ridership()
-    print(f"  {len(ride_df):,} rows, {ride_df['route_id'].n_unique()} routes, "
-          f"{ride_df['day_type'].n_unique()} day types")
-    print(f"  Day types: {sorted(ride_df['day_type'].unique().to_list())}")
-    print(f"  Month range: {ride_df['month'].min()} to {ride_df['month'].max()}")
+    n_rows, n_routes, day_types, first_month, last_month = ride_df.select(
+        pl.len(),
+        pl.col("route_id").n_unique(),
+        pl.col("day_type").unique().sort().implode(),
+        pl.col("month").min().alias("first"),
+        pl.col("month").max().alias("last"),
+    ).row(0)
+    print(f"  {n_rows:,} rows, {n_routes} routes, {len(day_types)} day types")
+    print(f"  Day types: {day_types}")
+    print(f"  Month range: {first_month} to {last_month}")
 
     print("\nComputing system-wide monthly ridership by day type...")
-    monthly = system_monthly(ride_df)
+    monthly = system_monthly()
+    monthly_idx = index_to_baseline(monthly, "2019-01")
 
     # Summary stats by day type
     print("\n  Day type summary (total monthly riders, averaged across months):")
@@ -276,7 +304,6 @@ def main() -> None:
         print(f"    {dt:<12s}: {avg:>12,.0f} avg monthly riders")
 
     print("\nIndexing to Jan 2019 baseline...")
-    monthly_idx = index_to_baseline(monthly, "2019-01")
 
     # Latest index values
     latest_month = monthly_idx["month"].max()
@@ -289,16 +316,17 @@ def main() -> None:
     wk_share = weekend_share_monthly(monthly)
 
     # Pre-COVID vs latest weekend share
-    pre_covid_avg = wk_share.filter(
-        (pl.col("month") >= "2019-01") & (pl.col("month") <= "2020-02")
-    )["weekend_share"].mean()
-    post_2023_avg = wk_share.filter(pl.col("month") >= "2023-01")["weekend_share"].mean()
+    share, month = pl.col("weekend_share"), pl.col("month")
+    pre_covid_avg, post_2023_avg = wk_share.select(
+        pre=share.filter((month >= "2019-01") & (month <= "2020-02")).mean(),
+        post=share.filter(month >= "2023-01").mean(),
+    ).row(0)
     print(f"\n  Weekend share (pre-COVID, 2019-01 to 2020-02): {pre_covid_avg:.1%}")
     print(f"  Weekend share (2023-01 to latest):             {post_2023_avg:.1%}")
     print(f"  Change: {post_2023_avg - pre_covid_avg:+.1%}")
 
     print("\nComputing per-route weekend-to-weekday ratio...")
-    route_wkend = route_weekend_share(ride_df)
+    route_wkend = route_weekend_share()
     print(f"  {len(route_wkend)} routes with 6+ months of all three day types")
 
     if len(route_wkend) > 0:
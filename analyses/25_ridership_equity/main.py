@@ -5,17 +5,18 @@ from pathlib import Path
 import numpy as np
 import polars as pl
 
-from prt_otp_analysis.common import output_dir, query_to_polars, setup_plotting
+from prt_otp_analysis.common import cached_query_to_polars, output_dir, setup_plotting
 
 HERE = Path(__file__).resolve().parent
 OUT = output_dir(HERE)
+CACHE = HERE / ".cache"
 
 MIN_MONTHS = 12
 
 
 def load_data() -> pl.DataFrame:
     """Load route-level average OTP, ridership, and mode."""
-    df = query_to_polars("""
+    paired = cached_query_to_polars("""
         SELECT o.route_id, o.month, o.otp,
                r.avg_riders,
                rt.mode
@@ -25,14 +26,16 @@ def load_data() -> pl.DataFrame:
             AND r.day_type = 'WEEKDAY'
         JOIN routes rt ON o.route_id = rt.route_id
         WHERE r.avg_riders IS NOT NULL
-    """)
-
-    # Filter to routes with enough paired months
-    route_counts = df.group_by("route_id").agg(pl.col("month").count().alias("n"))
-    keep = route_counts.filter(pl.col("n") >= MIN_MONTHS)["route_id"].to_list()
-    df = df.filter(pl.col("route_id").is_in(keep))
-
-    return df
+    """, CACHE, "paired_monthly").lazy()
+
+    # Filter to routes with enough paired months (semi-join, one streaming collect)
+    keep = (
+        paired.group_by("route_id")
+        .agg(n=pl.col("month").count())
+        .filter(pl.col("n") >= MIN_MONTHS)
+        .select("route_id")
+    )
+    return paired.join(keep, on="route_id", how="semi").collect(engine="streaming")
 
 
 def route_summary(df: pl.DataFrame) -> pl.DataFrame:
@@ -48,6 +51,31 @@ def route_summary(df: pl.DataFrame) -> pl.DataFrame:
     )
 
 
+def lorenz_kernel(riders: np.ndarray) -> tuple[float, int, np.ndarray, np.ndarray]:
+    """Lorenz curve and Gini-like index for riders ordered worst-to-best by OTP.
+
+    Returns (gini, idx_50, cum_route_share, cum_rider_share). Both curves start at
+    the origin; idx_50 is the position of the route at which 50% of riders is reached.
+    """
+    riders = np.ascontiguousarray(riders, dtype=np.float64)
+    n = len(riders)
+    total = riders.sum()
+
+    cum_route_share = np.arange(n + 1, dtype=np.float64) / n
+    cum_rider_share = np.empty(n + 1)
+    cum_rider_share[0] = 0.0
+    np.cumsum(riders, out=cum_rider_share[1:])
+    cum_rider_share[1:] /= total
+
+    # Gini-like index: twice the area between curve and diagonal, in closed form
+    # over the OTP-ordered riders. Positive = riders concentrate on low-OTP routes
+    rank = np.arange(1, n + 1, dtype=np.float64)
+    gini = ((n + 1) * total - 2.0 * np.dot(rank, riders)) / (n * total)
+
+    idx_50 = int(np.searchsorted(cum_rider_share[1:], 0.5))
+    return float(gini), idx_50, cum_route_share, cum_rider_share
+
+
 def compute_lorenz(routes: pl.DataFrame) -> dict:
     """Compute Lorenz curve data and Gini-like concentration index.
 
@@ -56,62 +84,50 @@ def compute_lorenz(routes: pl.DataFrame) -> dict:
     If riders concentrate on low-OTP routes, the curve bows above
     the diagonal.
     """
-    routes = routes.sort("avg_otp")  # worst to best
-    riders = routes["avg_riders"].to_numpy()
-    total = riders.sum()
-
-    n = len(riders)
-    cum_route_share = np.arange(1, n + 1) / n
-    cum_rider_share = np.cumsum(riders) / total
-
-    # Gini-like index: area between curve and diagonal
-    # Positive = riders concentrate on low-OTP routes
-    # Use trapezoidal integration
-    area_under_curve = np.trapezoid(cum_rider_share, cum_route_share)
-    area_under_diagonal = 0.5  # triangle
-    gini = 2 * (area_under_curve - area_under_diagonal)
+    if not routes["avg_otp"].is_sorted():  # route_summary output already is
+        routes = routes.sort("avg_otp")  # worst to best
+    gini, idx_50, cum_route_share, cum_rider_share = lorenz_kernel(
+        routes["avg_riders"].to_numpy()
+    )
+    n = len(routes)
 
     # Find OTP threshold below which 50% of ridership is carried
-    otp_vals = routes["avg_otp"].to_list()
-    idx_50 = np.searchsorted(cum_rider_share, 0.5)
-    if idx_50 < n:
-        otp_at_50 = otp_vals[idx_50]
-    else:
-        otp_at_50 = otp_vals[-1]
+    otp_vals = routes["avg_otp"].to_numpy()
+    otp_at_50 = float(otp_vals[min(idx_50, n - 1)])
 
     # Routes needed for 50% of ridership
-    routes_for_50 = int(idx_50 + 1)
+    routes_for_50 = min(idx_50, n - 1) + 1
 
     return {
-        "cum_route_share": np.concatenate([[0], cum_route_share]),
-        "cum_rider_share": np.concatenate([[0], cum_rider_share]),
+        "cum_route_share": cum_route_share,
+        "cum_rider_share": cum_rider_share,
         "gini": gini,
         "otp_at_50_pct": otp_at_50,
         "routes_for_50_pct": routes_for_50,
+        "route_share_at_50_pct": float(cum_route_share[routes_for_50]),
         "n_routes": n,
         "otp_values": otp_vals,
     }
 
 
-def compute_quintiles(routes: pl.DataFrame) -> pl.DataFrame:
-    """Divide routes into OTP quintiles and compute summary stats."""
-    routes = routes.sort("avg_otp")
-    n = len(routes)
-    quintile_size = n // 5
-    remainder = n % 5
+def compute_quintiles(subsets: dict[str, pl.DataFrame]) -> pl.DataFrame:
+    """Divide each subset's routes into OTP quintiles and summarize all subsets in one group_by."""
+    labeled = []
+    for name, routes in subsets.items():
+        if not routes["avg_otp"].is_sorted():
+            routes = routes.sort("avg_otp")
+        n = len(routes)
 
-    # Assign quintile labels (Q1 = worst, Q5 = best)
-    labels = []
-    for q in range(1, 6):
-        size = quintile_size + (1 if q <= remainder else 0)
-        labels.extend([f"Q{q}"] * size)
+        # Assign quintile labels (Q1 = worst, Q5 = best); the first n % 5 get one extra
+        sizes = np.full(5, n // 5)
+        sizes[:n % 5] += 1
+        labels = np.repeat(np.array(["Q1", "Q2", "Q3", "Q4", "Q5"]), sizes)
 
-    routes = routes.with_columns(
-        pl.Series("quintile", labels),
-    )
+        labeled.append(routes.with_columns(pl.Series("quintile", labels), subset=pl.lit(name)))
 
-    summary = (
-        routes.group_by("quintile")
+    return (
+        pl.concat(labeled)
+        .group_by("subset", "quintile")
         .agg(
             n_routes=pl.col("route_id").count(),
             avg_otp=pl.col("avg_otp").mean(),
@@ -120,17 +136,16 @@ def compute_quintiles(routes: pl.DataFrame) -> pl.DataFrame:
             total_riders=pl.col("avg_riders").sum(),
             avg_riders=pl.col("avg_riders").mean(),
         )
-        .sort("quintile")
-    )
-
-    # Add ridership share
-    total = summary["total_riders"].sum()
-    summary = summary.with_columns(
-        (pl.col("total_riders") / total * 100).alias("ridership_share_pct"),
+        # Ridership share within each subset
+        .with_columns(
+            ridership_share_pct=(
+                pl.col("total_riders") / pl.col("total_riders").sum().over("subset") * 100
+            ),
+        )
+        .sort("subset", "quintile")
+        .select(pl.exclude("subset"), "subset")
     )
 
-    return summary
-
 
 def make_lorenz_chart(lorenz_all: dict, lorenz_bus: dict) -> None:
     """Plot Lorenz curves for all routes and bus-only."""
@@ -153,20 +168,18 @@ def make_lorenz_chart(lorenz_all: dict, lorenz_bus: dict) -> None:
             alpha=0.15, color="#2563eb",
         )
 
-        # Mark 50% ridership point
-        idx_50 = np.searchsorted(lorenz["cum_rider_share"], 0.5)
-        if idx_50 < len(lorenz["cum_route_share"]):
-            x50 = lorenz["cum_route_share"][idx_50]
-            ax.axhline(0.5, color="#e11d48", linestyle=":", alpha=0.4)
-            ax.axvline(x50, color="#e11d48", linestyle=":", alpha=0.4)
-            ax.plot(x50, 0.5, "o", color="#e11d48", markersize=6, zorder=4)
-            ax.annotate(
-                f"50% riders\n({lorenz['routes_for_50_pct']}/{lorenz['n_routes']} routes"
-                f"\nOTP < {lorenz['otp_at_50_pct']:.1%})",
-                xy=(x50, 0.5), xytext=(x50 + 0.12, 0.35),
-                fontsize=8, color="#e11d48",
-                arrowprops=dict(arrowstyle="->", color="#e11d48", lw=1.0),
-            )
+        # Mark 50% ridership point (position found once in compute_lorenz)
+        x50 = lorenz["route_share_at_50_pct"]
+        ax.axhline(0.5, color="#e11d48", linestyle=":", alpha=0.4)
+        ax.axvline(x50, color="#e11d48", linestyle=":", alpha=0.4)
+        ax.plot(x50, 0.5, "o", color="#e11d48", markersize=6, zorder=4)
+        ax.annotate(
+            f"50% riders\n({lorenz['routes_for_50_pct']}/{lorenz['n_routes']} routes"
+            f"\nOTP < {lorenz['otp_at_50_pct']:.1%})",
+            xy=(x50, 0.5), xytext=(x50 + 0.12, 0.35),
+            fontsize=8, color="#e11d48",
+            arrowprops=dict(arrowstyle="->", color="#e11d48", lw=1.0),
+        )
 
         ax.set_xlabel("Cumulative Share of Routes (worst OTP -> best)")
         ax.set_ylabel("Cumulative Share of Ridership")
@@ -234,6 +247,28 @@ def make_quintile_chart(quintiles_all: pl.DataFrame, quintiles_bus: pl.DataFrame
     print(f"  Chart saved to {OUT / 'quintile_summary.png'}")
 
 
+def fixed_1dp(col: str, scale: float, suffix: str, width: int = 0) -> pl.Expr:
+    """Expression rendering col * scale with one decimal plus suffix, right-aligned to width."""
+    text = (pl.col(col) * scale).round(1).cast(pl.String) + suffix
+    return text.str.pad_start(width) if width else text
+
+
+def quintile_table(quintiles: pl.DataFrame) -> str:
+    """Format quintile summary rows for printing, building every line in one Polars select."""
+    lines = quintiles.select(
+        pl.format(
+            "  {} {} {} {} - {} {}",
+            pl.col("quintile").str.pad_end(10),
+            pl.col("n_routes").cast(pl.String).str.pad_start(7),
+            fixed_1dp("avg_otp", 100, "%", 9),
+            fixed_1dp("min_otp", 100, "%", 8),
+            fixed_1dp("max_otp", 100, "%"),
+            fixed_1dp("ridership_share_pct", 1, "%", 11),
+        )
+    ).to_series()
+    return "\n".join(lines)
+
+
 def main() -> None:
     """Entry point: load data, compute Lorenz/Gini, quintiles, chart, and save."""
     print("=" * 60)
@@ -266,20 +301,19 @@ def main() -> None:
 
     # Quintiles
     print("\nComputing quintile breakdowns...")
-    quintiles_all = compute_quintiles(routes_all)
-    quintiles_bus = compute_quintiles(routes_bus)
+    quintile_detail = compute_quintiles({"all": routes_all, "bus": routes_bus})
+    # A subset with no routes has no rows; look each one up and fall back to an empty table
+    parts = quintile_detail.partition_by("subset", as_dict=True)
+    quintiles_all = parts.get(("all",), quintile_detail.clear())
+    quintiles_bus = parts.get(("bus",), quintile_detail.clear())
 
     print("\n  All routes quintiles:")
     print(f"  {'Quintile':<10} {'Routes':>7} {'Avg OTP':>9} {'OTP Range':>18} {'Ridership%':>11}")
-    for row in quintiles_all.iter_rows(named=True):
-        print(f"  {row['quintile']:<10} {row['n_routes']:>7} {row['avg_otp']:>9.1%} "
-              f"{row['min_otp']:>8.1%} - {row['max_otp']:.1%} {row['ridership_share_pct']:>10.1f}%")
+    print(quintile_table(quintiles_all))
 
     print("\n  Bus-only quintiles:")
     print(f"  {'Quintile':<10} {'Routes':>7} {'Avg OTP':>9} {'OTP Range':>18} {'Ridership%':>11}")
-    for row in quintiles_bus.iter_rows(named=True):
-        print(f"  {row['quintile']:<10} {row['n_routes']:>7} {row['avg_otp']:>9.1%} "
-              f"{row['min_otp']:>8.1%} - {row['max_otp']:.1%} {row['ridership_share_pct']:>10.1f}%")
+    print(quintile_table(quintiles_bus))
 
     # Equity metrics CSV
     print("\nSaving CSV...")
@@ -297,9 +331,7 @@ def main() -> None:
     print(f"  {OUT / 'equity_metrics.csv'}")
 
     # Also save quintile detail
-    quintiles_all.with_columns(pl.lit("all").alias("subset")).vstack(
-        quintiles_bus.with_columns(pl.lit("bus").alias("subset"))
-    ).write_csv(OUT / "quintile_detail.csv")
+    quintile_detail.write_csv(OUT / "quintile_detail.csv")
     print(f"  {OUT / 'quintile_detail.csv'}")
 
     print("\nGenerating charts...")
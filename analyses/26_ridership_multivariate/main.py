@@ -1,117 +1,179 @@
 """Analysis 26: Test whether ridership adds explanatory power to the Analysis 18 multivariate OTP model."""
 
-import math
 from pathlib import Path
 
 import numpy as np
 import polars as pl
-from scipy import stats
+from scipy import linalg, stats
 
 from prt_otp_analysis.common import (
-    classify_bus_route,
+    bus_route_class,
+    cached_frame,
     output_dir,
     query_to_polars,
     setup_plotting,
+    significance_stars,
 )
 
 HERE = Path(__file__).resolve().parent
 OUT = output_dir(HERE)
+CACHE = HERE / ".cache"
 
 MIN_MONTHS = 12
 
+# Every predictor any model uses, in design-matrix column order
+ALL_FEATURES = ["stop_count", "span_km", "is_rail", "is_premium_bus",
+                "weekend_ratio", "n_munis", "log_riders"]
+
 
 # ---------------------------------------------------------------------------
 # Helpers (replicated from Analysis 18 to maintain independence)
 # ---------------------------------------------------------------------------
 
-def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    """Return the great-circle distance in km between two lat/lon points."""
+def compute_span(lats: np.ndarray, lons: np.ndarray, block: int = 256) -> float:
+    """Return the max pairwise haversine distance (km) among a set of points.
+
+    The distance is monotone in the haversine term a, so the max is taken over a and
+    converted to km once. Rows are processed in blocks against the columns at or
+    after the block, bounding memory at block x n for very long routes.
+    """
     R = 6371.0
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = (math.sin(dlat / 2) ** 2
-         + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2))
-         * math.sin(dlon / 2) ** 2)
-    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-
-def compute_span(lats: list[float], lons: list[float]) -> float:
-    """Return the max pairwise haversine distance (km) among a set of points."""
-    max_dist = 0.0
-    n = len(lats)
-    for i in range(n):
-        for j in range(i + 1, n):
-            d = haversine_km(lats[i], lons[i], lats[j], lons[j])
-            if d > max_dist:
-                max_dist = d
-    return max_dist
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    lon = np.radians(np.asarray(lons, dtype=np.float64))
+    n = len(lat)
+    if n < 2:
+        return 0.0
+    cos_lat = np.cos(lat)
+    a_max = 0.0
+    for start in range(0, n, block):
+        rows = slice(start, min(start + block, n))
+        dlat = lat[rows, None] - lat[None, start:]
+        dlon = lon[rows, None] - lon[None, start:]
+        a = (np.sin(dlat / 2) ** 2
+             + cos_lat[rows, None] * cos_lat[None, start:] * np.sin(dlon / 2) ** 2)
+        a_max = max(a_max, float(a.max()))
+    return float(R * 2 * np.arcsin(np.sqrt(min(a_max, 1.0))))
+
+
+def feature_columns(features: list[str]) -> list[int]:
+    """Return the ALL_FEATURES column indices for a model's feature list."""
+    return [ALL_FEATURES.index(f) for f in features]
+
+
+def build_design(y: np.ndarray, X_all: np.ndarray) -> dict:
+    """Return the design [1 | X_all] with its OLS sufficient statistics.
+
+    Every model uses a column subset of this design, so a fit only needs the matching
+    block of X'X and entries of X'y; the data is scanned once here, not once per model.
+    """
+    n = len(y)
+    X = np.column_stack([np.ones(n), X_all])
+    return {
+        "n": n,
+        "y": y,
+        "X": X,
+        "gram": X.T @ X,
+        "xty": X.T @ y,
+        "yty": float(y @ y),
+        "y_sum": float(y.sum()),
+    }
+
+
+def solve_normal_equations(XtX: np.ndarray, Xty: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return (beta, (X'X)^-1) from one Cholesky factorization of X'X.
+
+    Solving against [X'y | I] yields both at once; falls back to the pseudo-inverse
+    if X'X is singular.
+    """
+    p = XtX.shape[0]
+    try:
+        cho = linalg.cho_factor(XtX, check_finite=False)
+        rhs = np.empty((p, p + 1))
+        rhs[:, 0] = Xty
+        rhs[:, 1:] = np.eye(p)
+        sol = linalg.cho_solve(cho, rhs, check_finite=False)
+        return sol[:, 0], sol[:, 1:]
+    except linalg.LinAlgError:
+        XtX_inv = np.linalg.pinv(XtX)
+        return XtX_inv @ Xty, XtX_inv
 
 
 def compute_vif(X_raw: np.ndarray, feature_names: list[str]) -> dict[str, float]:
-    """Compute Variance Inflation Factor for each predictor."""
-    n, k = X_raw.shape
-    vifs = {}
-    for j in range(k):
-        y_j = X_raw[:, j]
-        X_other = np.delete(X_raw, j, axis=1)
-        X_other = np.column_stack([np.ones(n), X_other])
-        beta, _, _, _ = np.linalg.lstsq(X_other, y_j, rcond=None)
-        y_hat = X_other @ beta
-        ss_res = np.sum((y_j - y_hat) ** 2)
-        ss_tot = np.sum((y_j - np.mean(y_j)) ** 2)
-        r2_j = 1 - ss_res / ss_tot if ss_tot > 0 else 0.0
-        vifs[feature_names[j]] = 1.0 / (1.0 - r2_j) if r2_j < 1.0 else float("inf")
-    return vifs
-
-
-def fit_ols(y: np.ndarray, X_raw: np.ndarray, feature_names: list[str]) -> dict:
-    """Fit OLS regression and return results dict."""
-    n, k = X_raw.shape
-    X = np.column_stack([np.ones(n), X_raw])
-
-    beta, _, _, _ = np.linalg.lstsq(X, y, rcond=None)
-    y_hat = X @ beta
-    residuals = y - y_hat
-
-    ss_res = np.sum(residuals ** 2)
-    ss_tot = np.sum((y - np.mean(y)) ** 2)
+    """Compute Variance Inflation Factor for each predictor.
+
+    VIF_j = 1 / (1 - R2_j) equals the j-th diagonal of the inverse correlation matrix
+    of the predictors, so one k x k inversion replaces k auxiliary regressions.
+    """
+    corr = np.corrcoef(X_raw, rowvar=False)
+    try:
+        vif = np.diag(np.linalg.inv(corr))
+    except np.linalg.LinAlgError:
+        vif = np.diag(np.linalg.pinv(corr))
+    vif = np.where(vif > 1e12, np.inf, vif)
+    return dict(zip(feature_names, vif.tolist()))
+
+
+def fit_ols(design: dict, feature_names: list[str], return_predictions: bool = False) -> dict:
+    """Fit OLS regression on a subset of the design columns and return results dict.
+
+    The residual sum of squares is y'y - beta'X'y, so y_hat and residuals are only
+    materialized when return_predictions is set.
+    """
+    n, k = design["n"], len(feature_names)
+    cols = [0] + [c + 1 for c in feature_columns(feature_names)]
+    XtX = design["gram"][np.ix_(cols, cols)]
+    Xty = design["xty"][cols]
+
+    beta, XtX_inv = solve_normal_equations(XtX, Xty)
+    ss_res = design["yty"] - float(beta @ Xty)
+    ss_tot = design["yty"] - design["y_sum"] ** 2 / n
+    dof_resid = n - k - 1
     r_squared = 1 - ss_res / ss_tot
-    adj_r_squared = 1 - (1 - r_squared) * (n - 1) / (n - k - 1)
-    mse = ss_res / (n - k - 1)
+    adj_r_squared = 1 - (1 - r_squared) * (n - 1) / dof_resid
+    mse = ss_res / dof_resid
 
-    XtX_inv = np.linalg.pinv(X.T @ X)
     se = np.sqrt(np.diag(XtX_inv) * mse)
     t_vals = beta / se
-    p_vals = [2 * (1 - stats.t.cdf(abs(t), df=n - k - 1)) for t in t_vals]
+    p_vals = 2.0 * stats.t.sf(np.abs(t_vals), df=dof_resid)
 
-    # Standardized beta weights
-    x_stds = np.std(X_raw, axis=0, ddof=1)
-    y_std = np.std(y, ddof=1)
+    # Standardized beta weights (sample SDs from the Gram block's sums and sums of squares)
+    x_stds = np.sqrt((np.diag(XtX)[1:] - XtX[0, 1:] ** 2 / n) / (n - 1))
+    y_std = np.sqrt(ss_tot / (n - 1))
     beta_weights = beta[1:] * x_stds / y_std
 
-    return {
+    results = {
         "r_squared": r_squared,
         "adj_r_squared": adj_r_squared,
         "ss_res": ss_res,
         "n": n,
         "k": k,
+        "dof_resid": dof_resid,
         "features": ["intercept"] + feature_names,
-        "coefficients": beta.tolist(),
-        "std_errors": se.tolist(),
-        "t_values": t_vals.tolist(),
+        # Per-term arrays aligned with features; the intercept has no beta weight (NaN)
+        "coefficients": beta,
+        "std_errors": se,
+        "t_values": t_vals,
         "p_values": p_vals,
-        "beta_weights": [None] + beta_weights.tolist(),
-        "y_hat": y_hat,
-        "residuals": residuals,
+        "beta_weights": np.concatenate([[np.nan], beta_weights]),
+        # Per-feature lookups (intercept excluded) for charts
+        "beta_by_feat": dict(zip(feature_names, beta_weights.tolist())),
+        "p_by_feat": dict(zip(feature_names, p_vals[1:].tolist())),
     }
+    if return_predictions:
+        # Zero-filled full-width coefficients predict without copying the column subset
+        beta_full = np.zeros(design["X"].shape[1])
+        beta_full[cols] = beta
+        results["y_hat"] = design["X"] @ beta_full
+        results["residuals"] = design["y"] - results["y_hat"]
+    return results
 
 
 def f_test_nested(base: dict, full: dict) -> tuple[float, float]:
     """F-test comparing nested models. Returns (F_stat, p_value)."""
     k_diff = full["k"] - base["k"]
-    n = full["n"]
-    f_stat = ((base["ss_res"] - full["ss_res"]) / k_diff) / (full["ss_res"] / (n - full["k"] - 1))
-    f_p = 1 - stats.f.cdf(f_stat, k_diff, n - full["k"] - 1)
+    dof = full["dof_resid"]
+    f_stat = ((base["ss_res"] - full["ss_res"]) / k_diff) / (full["ss_res"] / dof)
+    f_p = 1 - stats.f.cdf(f_stat, k_diff, dof)
     return f_stat, f_p
 
 
@@ -122,82 +184,81 @@ def print_model(results: dict, label: str) -> None:
           f"n = {results['n']}, k = {results['k']}")
     print(f"  {'Feature':<20s} {'Coeff':>10s} {'Std Err':>10s} {'p-value':>10s} {'Beta':>10s}")
     print(f"  {'-'*60}")
+    stars = significance_stars(results["p_values"])
     for i, feat in enumerate(results["features"]):
         coeff = results["coefficients"][i]
         se = results["std_errors"][i]
         p = results["p_values"][i]
         beta = results["beta_weights"][i]
-        beta_str = f"{beta:>10.4f}" if beta is not None else f"{'--':>10s}"
-        sig = "***" if p < 0.001 else "**" if p < 0.01 else "*" if p < 0.05 else ""
-        print(f"  {feat:<20s} {coeff:>10.6f} {se:>10.6f} {p:>10.4f} {beta_str} {sig}")
+        beta_str = f"{'--':>10s}" if np.isnan(beta) else f"{beta:>10.4f}"
+        print(f"  {feat:<20s} {coeff:>10.6f} {se:>10.6f} {p:>10.4f} {beta_str} {stars[i]}")
 
 
 # ---------------------------------------------------------------------------
 # Data loading
 # ---------------------------------------------------------------------------
 
-def load_features() -> pl.DataFrame:
-    """Assemble all features including ridership for the regression model."""
-    # Route-level average OTP (from paired months only)
-    avg_otp = query_to_polars("""
-        SELECT o.route_id, rt.route_name, rt.mode,
-               AVG(o.otp) AS avg_otp, COUNT(*) AS months
-        FROM otp_monthly o
-        JOIN ridership_monthly r
-            ON o.route_id = r.route_id AND o.month = r.month
-            AND r.day_type = 'WEEKDAY'
-        JOIN routes rt ON o.route_id = rt.route_id
-        WHERE r.avg_riders IS NOT NULL
-        GROUP BY o.route_id
-        HAVING COUNT(*) >= 12
-    """)
-
-    # Average weekday ridership
-    avg_riders = query_to_polars("""
+# Route-level average OTP (from paired months only) and average weekday
+# ridership (over all weekday months) in one query
+ROUTE_PERF_SQL = """
+    SELECT o.route_id, rt.route_name, rt.mode,
+           AVG(o.otp) AS avg_otp, COUNT(*) AS months,
+           ar.avg_riders
+    FROM otp_monthly o
+    JOIN ridership_monthly r
+        ON o.route_id = r.route_id AND o.month = r.month
+        AND r.day_type = 'WEEKDAY'
+    JOIN routes rt ON o.route_id = rt.route_id
+    JOIN (
         SELECT route_id, AVG(avg_riders) AS avg_riders
         FROM ridership_monthly
         WHERE day_type = 'WEEKDAY' AND avg_riders IS NOT NULL
         GROUP BY route_id
-    """)
-
-    # Structural features
-    stop_counts = query_to_polars("""
-        SELECT route_id, COUNT(DISTINCT stop_id) AS stop_count
-        FROM route_stops GROUP BY route_id
-    """)
-    trips = query_to_polars("""
-        SELECT route_id,
-               MAX(trips_wd) AS max_wd,
-               MAX(trips_sa) AS max_sa,
-               MAX(trips_su) AS max_su
-        FROM route_stops GROUP BY route_id
-    """)
-    munis = query_to_polars("""
-        SELECT rs.route_id, COUNT(DISTINCT s.muni) AS n_munis
-        FROM route_stops rs
-        JOIN stops s ON rs.stop_id = s.stop_id
-        WHERE s.muni IS NOT NULL AND s.muni != '0'
-        GROUP BY rs.route_id
-    """)
-    stops_by_route = query_to_polars("""
-        SELECT rs.route_id, s.lat, s.lon
-        FROM route_stops rs
-        JOIN stops s ON rs.stop_id = s.stop_id
-        WHERE s.lat IS NOT NULL AND s.lon IS NOT NULL
-    """)
-    spans = []
-    for route_id in stops_by_route["route_id"].unique().sort().to_list():
-        subset = stops_by_route.filter(pl.col("route_id") == route_id)
-        span_km = compute_span(subset["lat"].to_list(), subset["lon"].to_list())
-        spans.append({"route_id": route_id, "span_km": span_km})
-    span_df = pl.DataFrame(spans)
+    ) ar ON o.route_id = ar.route_id
+    WHERE r.avg_riders IS NOT NULL
+    GROUP BY o.route_id
+    HAVING COUNT(*) >= ?
+"""
+
+# Structural features: stop count, peak trips per day type and municipalities
+# (NULL when a route has no known municipality, as with an inner join)
+STRUCTURE_SQL = """
+    SELECT rs.route_id,
+           COUNT(DISTINCT rs.stop_id) AS stop_count,
+           MAX(rs.trips_wd) AS max_wd,
+           MAX(rs.trips_sa) AS max_sa,
+           MAX(rs.trips_su) AS max_su,
+           NULLIF(COUNT(DISTINCT CASE WHEN s.muni IS NOT NULL AND s.muni != '0'
+                                      THEN s.muni END), 0) AS n_munis
+    FROM route_stops rs
+    LEFT JOIN stops s ON rs.stop_id = s.stop_id
+    GROUP BY rs.route_id
+"""
+
+STOP_COORDS_SQL = """
+    SELECT rs.route_id, s.lat, s.lon
+    FROM route_stops rs
+    JOIN stops s ON rs.stop_id = s.stop_id
+    WHERE s.lat IS NOT NULL AND s.lon IS NOT NULL
+"""
+
+
+def build_features() -> pl.DataFrame:
+    """Assemble all features including ridership for the regression model."""
+    route_perf = query_to_polars(ROUTE_PERF_SQL, (MIN_MONTHS,))
+    structure = query_to_polars(STRUCTURE_SQL)
+    stops_by_route = query_to_polars(STOP_COORDS_SQL)
+    # One partition pass splits the stops by route; the span kernel runs per sub-frame
+    by_route = stops_by_route.partition_by("route_id", as_dict=True)
+    span_df = pl.DataFrame({
+        "route_id": [route_id for (route_id,) in by_route],
+        "span_km": [compute_span(sub["lat"].to_numpy(), sub["lon"].to_numpy())
+                    for sub in by_route.values()],
+    }, schema={"route_id": pl.Utf8, "span_km": pl.Float64})
 
     # Assemble
-    df = avg_otp
-    df = df.join(avg_riders, on="route_id", how="inner")
-    df = df.join(stop_counts, on="route_id", how="left")
-    df = df.join(trips, on="route_id", how="left")
-    df = df.join(munis, on="route_id", how="left")
+    df = route_perf
+    df = df.join(structure, on="route_id", how="left")
     df = df.join(span_df, on="route_id", how="left")
 
     # Derived features
@@ -212,7 +273,7 @@ def load_features() -> pl.DataFrame:
     )
     df = df.with_columns(
         pl.when(pl.col("mode") == "BUS")
-        .then(pl.col("route_id").map_elements(classify_bus_route, return_dtype=pl.Utf8))
+        .then(bus_route_class("route_id"))
         .otherwise(pl.lit("non_bus"))
         .alias("bus_subtype"),
     )
@@ -231,6 +292,15 @@ def load_features() -> pl.DataFrame:
     return df
 
 
+def load_features() -> pl.DataFrame:
+    """Load the assembled feature table, reusing the cached copy until prt.db changes."""
+    return cached_frame(
+        CACHE, "features",
+        (ROUTE_PERF_SQL, STRUCTURE_SQL, STOP_COORDS_SQL, MIN_MONTHS),
+        build_features,
+    )
+
+
 # ---------------------------------------------------------------------------
 # Charts
 # ---------------------------------------------------------------------------
@@ -240,14 +310,11 @@ def make_coefficient_chart(base: dict, expanded: dict) -> None:
     plt = setup_plotting()
     fig, ax = plt.subplots(figsize=(10, 7))
 
-    # Get shared features (skip intercept)
-    base_feats = base["features"][1:]
-    exp_feats = expanded["features"][1:]
-    base_betas = {f: b for f, b in zip(base_feats, base["beta_weights"][1:])}
-    exp_betas = {f: b for f, b in zip(exp_feats, expanded["beta_weights"][1:])}
-    exp_pvals = {f: p for f, p in zip(exp_feats, expanded["p_values"][1:])}
+    base_betas = base["beta_by_feat"]
+    exp_betas = expanded["beta_by_feat"]
+    exp_pvals = expanded["p_by_feat"]
 
-    all_feats = exp_feats  # expanded has all features
+    all_feats = expanded["features"][1:]  # expanded has all features (skip intercept)
     y_pos = np.arange(len(all_feats))
     width = 0.35
 
@@ -260,9 +327,8 @@ def make_coefficient_chart(base: dict, expanded: dict) -> None:
                      color="#2563eb", alpha=0.7)
 
     # Significance markers for expanded model
-    for i, f in enumerate(all_feats):
-        p = exp_pvals[f]
-        marker = "***" if p < 0.001 else "**" if p < 0.01 else "*" if p < 0.05 else ""
+    markers = significance_stars([exp_pvals[f] for f in all_feats])
+    for i, marker in enumerate(markers):
         val = exp_vals[i]
         ax.text(val + 0.01 if val >= 0 else val - 0.01, i - width / 2, marker,
                 ha="left" if val >= 0 else "right", va="center", fontsize=9)
@@ -291,7 +357,7 @@ def make_partial_residual_chart(df: pl.DataFrame, base: dict) -> None:
     log_riders = df["log_riders"].to_numpy()
 
     ax.scatter(log_riders, residuals, alpha=0.5, s=30, color="#2563eb",
-               edgecolors="white", linewidth=0.5)
+               edgecolors="white", linewidth=0.5, rasterized=True)
 
     # Trend line
     slope, intercept, r, p, _ = stats.linregress(log_riders, residuals)
@@ -323,27 +389,32 @@ def main() -> None:
 
     print("\nLoading and assembling features...")
     df = load_features()
-    n_rail = len(df.filter(pl.col("is_rail") == 1.0))
-    n_bus = len(df.filter(pl.col("mode") == "BUS"))
+    # One boolean mask per mode, reused for the counts and the bus-only models
+    mode = df["mode"].to_numpy()
+    bus_mask = mode == "BUS"
+    n_bus = int(bus_mask.sum())
+    n_rail = int((mode == "RAIL").sum())
     print(f"  {len(df)} routes with complete feature set ({n_bus} BUS, {n_rail} RAIL)")
     print(f"  Ridership range: {df['avg_riders'].min():.0f} -- {df['avg_riders'].max():.0f}")
     print(f"  Log ridership range: {df['log_riders'].min():.2f} -- {df['log_riders'].max():.2f}")
 
     y = df["avg_otp"].to_numpy()
 
+    # Every candidate predictor as one Fortran-ordered float64 matrix; models take column subsets
+    X_all = np.asfortranarray(df.select(pl.col(ALL_FEATURES).cast(pl.Float64)).to_numpy())
+    design = build_design(y, X_all)
+
     # --- Model 1: Base (Analysis 18 replication, 6 features) ---
     base_features = ["stop_count", "span_km", "is_rail", "is_premium_bus",
                      "weekend_ratio", "n_munis"]
-    X_base = np.column_stack([df[f].to_numpy().astype(float) for f in base_features])
     print("\nFitting base model (6 features, Analysis 18 replication)...")
-    base = fit_ols(y, X_base, base_features)
+    base = fit_ols(design, base_features, return_predictions=True)
     print_model(base, "Base model (6 features)")
 
     # --- Model 2: Expanded (+ log_riders) ---
     exp_features = base_features + ["log_riders"]
-    X_exp = np.column_stack([df[f].to_numpy().astype(float) for f in exp_features])
     print("\nFitting expanded model (+ log_riders)...")
-    expanded = fit_ols(y, X_exp, exp_features)
+    expanded = fit_ols(design, exp_features)
     print_model(expanded, "Expanded model (+ log_riders)")
 
     # F-test
@@ -360,33 +431,28 @@ def main() -> None:
 
     # --- VIF for expanded model ---
     print("\n--- VIF (Expanded Model) ---")
-    vifs = compute_vif(X_exp, exp_features)
+    vifs = compute_vif(X_all[:, feature_columns(exp_features)], exp_features)
     for feat, vif in vifs.items():
         flag = " ** HIGH" if vif > 5 else ""
         print(f"  {feat:<20s} VIF = {vif:.2f}{flag}")
 
     # --- Model 3: Ridership-only (log_riders + is_rail) ---
     rider_features = ["log_riders", "is_rail"]
-    X_rider = np.column_stack([df[f].to_numpy().astype(float) for f in rider_features])
     print("\nFitting ridership-only model (log_riders + is_rail)...")
-    rider_only = fit_ols(y, X_rider, rider_features)
+    rider_only = fit_ols(design, rider_features)
     print_model(rider_only, "Ridership-only model")
 
     # --- Model 4: Bus-only expanded ---
-    bus_df = df.filter(pl.col("mode") == "BUS")
-    y_bus = bus_df["avg_otp"].to_numpy()
+    bus_design = build_design(y[bus_mask], X_all[bus_mask])
     bus_base_feats = ["stop_count", "span_km", "is_premium_bus", "weekend_ratio", "n_munis"]
     bus_exp_feats = bus_base_feats + ["log_riders"]
 
-    X_bus_base = np.column_stack([bus_df[f].to_numpy().astype(float) for f in bus_base_feats])
-    X_bus_exp = np.column_stack([bus_df[f].to_numpy().astype(float) for f in bus_exp_feats])
-
-    print(f"\nFitting bus-only base model ({len(bus_df)} routes)...")
-    bus_base = fit_ols(y_bus, X_bus_base, bus_base_feats)
+    print(f"\nFitting bus-only base model ({bus_design['n']} routes)...")
+    bus_base = fit_ols(bus_design, bus_base_feats)
     print_model(bus_base, "Bus-only base (5 features)")
 
     print(f"\nFitting bus-only expanded model (+ log_riders)...")
-    bus_expanded = fit_ols(y_bus, X_bus_exp, bus_exp_feats)
+    bus_expanded = fit_ols(bus_design, bus_exp_feats)
     print_model(bus_expanded, "Bus-only expanded (+ log_riders)")
 
     f_bus, fp_bus = f_test_nested(bus_base, bus_expanded)
@@ -396,32 +462,38 @@ def main() -> None:
 
     # --- Correlation between ridership and existing predictors ---
     print("\n--- Correlations: log_riders vs structural features ---")
-    for feat in base_features:
-        r, p = stats.pearsonr(df[feat].to_numpy().astype(float), df["log_riders"].to_numpy())
+    # One correlation matrix over [log_riders | base features]; p-values via the t-distribution
+    corr = np.corrcoef(X_all[:, feature_columns(["log_riders"] + base_features)], rowvar=False)
+    r_row = corr[0, 1:]
+    n = len(y)
+    t_row = r_row * np.sqrt((n - 2) / (1 - r_row ** 2))
+    p_row = 2 * stats.t.sf(np.abs(t_row), n - 2)
+    for feat, r, p in zip(base_features, r_row, p_row):
         sig = "*" if p < 0.05 else ""
         print(f"  log_riders vs {feat:<20s}: r = {r:+.3f}, p = {p:.4f} {sig}")
 
     # --- Save outputs ---
     print("\nSaving CSVs...")
 
-    # Model comparison
-    rows = []
+    # Model comparison: one column-wise frame per model, model-level stats broadcast
+    tables = []
     for model, label in [(base, "base_6feat"), (expanded, "expanded_7feat"),
                           (rider_only, "ridership_only"), (bus_base, "bus_base"),
                           (bus_expanded, "bus_expanded")]:
-        for i, feat in enumerate(model["features"]):
-            rows.append({
-                "model": label,
-                "feature": feat,
-                "coefficient": model["coefficients"][i],
-                "std_error": model["std_errors"][i],
-                "p_value": model["p_values"][i],
-                "beta_weight": model["beta_weights"][i] if model["beta_weights"][i] is not None else float("nan"),
-                "r_squared": model["r_squared"],
-                "adj_r_squared": model["adj_r_squared"],
-                "n": model["n"],
-            })
-    pl.DataFrame(rows).write_csv(OUT / "model_comparison.csv")
+        tables.append(pl.DataFrame({
+            "feature": model["features"],
+            "coefficient": model["coefficients"],
+            "std_error": model["std_errors"],
+            "p_value": model["p_values"],
+            "beta_weight": model["beta_weights"],
+        }).select(
+            pl.lit(label).alias("model"),
+            pl.all(),
+            pl.lit(float(model["r_squared"])).alias("r_squared"),
+            pl.lit(float(model["adj_r_squared"])).alias("adj_r_squared"),
+            pl.lit(model["n"], dtype=pl.Int64).alias("n"),
+        ))
+    pl.concat(tables).write_csv(OUT / "model_comparison.csv")
     print(f"  {OUT / 'model_comparison.csv'}")
 
     # VIF table
@@ -1,21 +1,23 @@
 """Analysis 27: Test whether PennDOT AADT traffic volume explains OTP variance beyond structural features."""
 
-import math
 from pathlib import Path
 
 import numpy as np
 import polars as pl
-from scipy import stats
+from scipy import linalg, stats
 
 from prt_otp_analysis.common import (
-    classify_bus_route,
+    bus_route_class,
+    cached_frame,
     output_dir,
     query_to_polars,
     setup_plotting,
+    significance_stars,
 )
 
 HERE = Path(__file__).resolve().parent
 OUT = output_dir(HERE)
+CACHE = HERE / ".cache"
 
 MIN_MONTHS = 12
 MIN_MATCH_RATE = 0.3
@@ -25,52 +27,85 @@ MIN_MATCH_RATE = 0.3
 # Helpers (replicated from Analysis 18/26 to maintain independence)
 # ---------------------------------------------------------------------------
 
-def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    """Return the great-circle distance in km between two lat/lon points."""
+def compute_span(lats: np.ndarray, lons: np.ndarray, block: int = 256) -> float:
+    """Return the max pairwise haversine distance (km) among a set of points.
+
+    On unit vectors u, the haversine term is a = (1 - u_i . u_j) / 2, so the farthest
+    pair is the smallest dot product: trig runs once per point and the pairwise pass
+    is a matrix product. Rows are processed in blocks against the columns at or after
+    the block, bounding memory at block x n for very long routes.
+    """
     R = 6371.0
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = (math.sin(dlat / 2) ** 2
-         + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2))
-         * math.sin(dlon / 2) ** 2)
-    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-
-def compute_span(lats: list[float], lons: list[float]) -> float:
-    """Return the max pairwise haversine distance (km) among a set of points."""
-    max_dist = 0.0
-    n = len(lats)
-    for i in range(n):
-        for j in range(i + 1, n):
-            d = haversine_km(lats[i], lons[i], lats[j], lons[j])
-            if d > max_dist:
-                max_dist = d
-    return max_dist
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    lon = np.radians(np.asarray(lons, dtype=np.float64))
+    n = len(lat)
+    if n < 2:
+        return 0.0
+    cos_lat = np.cos(lat)
+    xyz = np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+    dot_min = 1.0
+    for start in range(0, n, block):
+        dot_min = min(dot_min, float((xyz[start:start + block] @ xyz[start:].T).min()))
+    a_max = min(max((1.0 - dot_min) / 2, 0.0), 1.0)
+    return float(R * 2 * np.arcsin(np.sqrt(a_max)))
+
+
+def feature_matrix(df: pl.DataFrame, features: list[str]) -> np.ndarray:
+    """Return the feature columns as one float64 matrix from a single to_numpy()."""
+    return df.select(pl.col(features).cast(pl.Float64)).to_numpy()
 
 
 def compute_vif(X_raw: np.ndarray, feature_names: list[str]) -> dict[str, float]:
-    """Compute Variance Inflation Factor for each predictor."""
-    n, k = X_raw.shape
-    vifs = {}
-    for j in range(k):
-        y_j = X_raw[:, j]
-        X_other = np.delete(X_raw, j, axis=1)
-        X_other = np.column_stack([np.ones(n), X_other])
-        beta, _, _, _ = np.linalg.lstsq(X_other, y_j, rcond=None)
-        y_hat = X_other @ beta
-        ss_res = np.sum((y_j - y_hat) ** 2)
-        ss_tot = np.sum((y_j - np.mean(y_j)) ** 2)
-        r2_j = 1 - ss_res / ss_tot if ss_tot > 0 else 0.0
-        vifs[feature_names[j]] = 1.0 / (1.0 - r2_j) if r2_j < 1.0 else float("inf")
-    return vifs
-
-
-def fit_ols(y: np.ndarray, X_raw: np.ndarray, feature_names: list[str]) -> dict:
-    """Fit OLS regression and return results dict."""
-    n, k = X_raw.shape
+    """Compute Variance Inflation Factor for each predictor.
+
+    VIF_j = 1 / (1 - R2_j) equals the j-th diagonal of the inverse correlation matrix
+    of the predictors, so one k x k inversion replaces k auxiliary regressions.
+    """
+    corr = np.corrcoef(X_raw, rowvar=False)
+    try:
+        vif = np.diag(np.linalg.inv(corr))
+    except np.linalg.LinAlgError:
+        vif = np.diag(np.linalg.pinv(corr))
+    vif = np.where(vif > 1e12, np.inf, vif)
+    return dict(zip(feature_names, vif.tolist()))
+
+
+def qr_design(y: np.ndarray, X_raw: np.ndarray, feature_names: list[str]) -> dict:
+    """Factor the largest design [1 | X_raw] of a sample once for all nested models.
+
+    The first p columns of Q span the first p columns of X, so any model whose
+    features are a prefix of feature_names is solved from the leading block of R
+    and of Q'y without another factorization.
+    """
+    n = len(y)
+    # Kept in float64: a float32 factorization moves printed coefficients and the
+    # log_aadt F-test p-value in their last reported decimal
     X = np.column_stack([np.ones(n), X_raw])
-
-    beta, _, _, _ = np.linalg.lstsq(X, y, rcond=None)
+    Q, R = linalg.qr(X, mode="economic", check_finite=False)
+    return {"y": y, "X": X, "R": R, "qty": Q.T @ y, "features": feature_names}
+
+
+def fit_ols(design: dict, feature_names: list[str]) -> dict:
+    """Fit OLS on a leading subset of a qr_design's features and return results dict."""
+    k = len(feature_names)
+    if design["features"][:k] != feature_names:
+        raise ValueError(f"{feature_names} is not a prefix of {design['features']}")
+    y = design["y"]
+    n = len(y)
+    X = design["X"][:, :k + 1]
+    X_raw = X[:, 1:]
+
+    # beta and (X'X)^-1 = R^-1 R^-T from the leading (k+1) x (k+1) block of R
+    R = design["R"][:k + 1, :k + 1]
+    r_diag = np.abs(np.diag(R))
+    if r_diag.min() > r_diag.max() * n * np.finfo(np.float64).eps:
+        beta = linalg.solve_triangular(R, design["qty"][:k + 1], check_finite=False)
+        R_inv = linalg.solve_triangular(R, np.eye(k + 1), check_finite=False)
+        XtX_inv = R_inv @ R_inv.T
+    else:
+        # Rank-deficient design: minimum-norm solution via pivoted QR (gelsy)
+        beta = linalg.lstsq(X, y, lapack_driver="gelsy", check_finite=False)[0]
+        XtX_inv = np.linalg.pinv(X.T @ X)
     y_hat = X @ beta
     residuals = y - y_hat
 
@@ -80,10 +115,9 @@ def fit_ols(y: np.ndarray, X_raw: np.ndarray, feature_names: list[str]) -> dict:
     adj_r_squared = 1 - (1 - r_squared) * (n - 1) / (n - k - 1)
     mse = ss_res / (n - k - 1)
 
-    XtX_inv = np.linalg.pinv(X.T @ X)
     se = np.sqrt(np.diag(XtX_inv) * mse)
     t_vals = beta / se
-    p_vals = [2 * (1 - stats.t.cdf(abs(t), df=n - k - 1)) for t in t_vals]
+    p_vals = 2.0 * stats.t.sf(np.abs(t_vals), df=n - k - 1)
 
     x_stds = np.std(X_raw, axis=0, ddof=1)
     y_std = np.std(y, ddof=1)
@@ -99,7 +133,7 @@ def fit_ols(y: np.ndarray, X_raw: np.ndarray, feature_names: list[str]) -> dict:
         "coefficients": beta.tolist(),
         "std_errors": se.tolist(),
         "t_values": t_vals.tolist(),
-        "p_values": p_vals,
+        "p_values": p_vals.tolist(),
         "beta_weights": [None] + beta_weights.tolist(),
         "y_hat": y_hat,
         "residuals": residuals,
@@ -122,92 +156,102 @@ def print_model(results: dict, label: str) -> None:
           f"n = {results['n']}, k = {results['k']}")
     print(f"  {'Feature':<20s} {'Coeff':>10s} {'Std Err':>10s} {'p-value':>10s} {'Beta':>10s}")
     print(f"  {'-'*60}")
+    stars = significance_stars(results["p_values"])
     for i, feat in enumerate(results["features"]):
         coeff = results["coefficients"][i]
         se = results["std_errors"][i]
         p = results["p_values"][i]
         beta = results["beta_weights"][i]
         beta_str = f"{beta:>10.4f}" if beta is not None else f"{'--':>10s}"
-        sig = "***" if p < 0.001 else "**" if p < 0.01 else "*" if p < 0.05 else ""
-        print(f"  {feat:<20s} {coeff:>10.6f} {se:>10.6f} {p:>10.4f} {beta_str} {sig}")
+        print(f"  {feat:<20s} {coeff:>10.6f} {se:>10.6f} {p:>10.4f} {beta_str} {stars[i]}")
 
 
 # ---------------------------------------------------------------------------
 # Data loading
 # ---------------------------------------------------------------------------
 
-def load_features() -> pl.DataFrame:
-    """Assemble structural features + traffic data for the regression model."""
-    avg_otp = query_to_polars("""
-        SELECT o.route_id, r.route_name, r.mode,
-               AVG(o.otp) AS avg_otp, COUNT(*) AS months
-        FROM otp_monthly o
-        JOIN routes r ON o.route_id = r.route_id
-        GROUP BY o.route_id
-        HAVING COUNT(*) >= 12
-    """)
-
-    stop_counts = query_to_polars("""
-        SELECT route_id, COUNT(DISTINCT stop_id) AS stop_count
-        FROM route_stops GROUP BY route_id
-    """)
-    trips = query_to_polars("""
-        SELECT route_id,
-               MAX(trips_wd) AS max_wd,
-               MAX(trips_sa) AS max_sa,
-               MAX(trips_su) AS max_su
-        FROM route_stops GROUP BY route_id
-    """)
-    munis = query_to_polars("""
-        SELECT rs.route_id, COUNT(DISTINCT s.muni) AS n_munis
-        FROM route_stops rs
-        JOIN stops s ON rs.stop_id = s.stop_id
-        WHERE s.muni IS NOT NULL AND s.muni != '0'
-        GROUP BY rs.route_id
-    """)
-    stops_by_route = query_to_polars("""
-        SELECT rs.route_id, s.lat, s.lon
-        FROM route_stops rs
-        JOIN stops s ON rs.stop_id = s.stop_id
-        WHERE s.lat IS NOT NULL AND s.lon IS NOT NULL
-    """)
-    spans = []
-    for route_id in stops_by_route["route_id"].unique().sort().to_list():
-        subset = stops_by_route.filter(pl.col("route_id") == route_id)
-        span_km = compute_span(subset["lat"].to_list(), subset["lon"].to_list())
-        spans.append({"route_id": route_id, "span_km": span_km})
-    span_df = pl.DataFrame(spans)
-
-    # Traffic data
-    traffic = query_to_polars("""
-        SELECT route_id, weighted_aadt, max_aadt, median_aadt, p90_aadt,
-               avg_truck_pct, match_rate, n_segments, total_length_ft
-        FROM route_traffic
-    """)
+AVG_OTP_SQL = """
+    SELECT o.route_id, r.route_name, r.mode,
+           AVG(o.otp) AS avg_otp, COUNT(*) AS months
+    FROM otp_monthly o
+    JOIN routes r ON o.route_id = r.route_id
+    GROUP BY o.route_id
+    HAVING COUNT(*) >= 12
+"""
+
+# Structural features: stop count, peak trips per day type and municipalities
+# (NULL when a route has no known municipality, as with an inner join)
+STRUCTURE_SQL = """
+    SELECT rs.route_id,
+           COUNT(DISTINCT rs.stop_id) AS stop_count,
+           MAX(rs.trips_wd) AS max_wd,
+           MAX(rs.trips_sa) AS max_sa,
+           MAX(rs.trips_su) AS max_su,
+           NULLIF(COUNT(DISTINCT CASE WHEN s.muni IS NOT NULL AND s.muni != '0'
+                                      THEN s.muni END), 0) AS n_munis
+    FROM route_stops rs
+    LEFT JOIN stops s ON rs.stop_id = s.stop_id
+    GROUP BY rs.route_id
+"""
+
+STOP_COORDS_SQL = """
+    SELECT rs.route_id, s.lat, s.lon
+    FROM route_stops rs
+    JOIN stops s ON rs.stop_id = s.stop_id
+    WHERE s.lat IS NOT NULL AND s.lon IS NOT NULL
+      AND rs.route_id IN (SELECT route_id FROM route_traffic WHERE match_rate >= ?)
+"""
+
+TRAFFIC_SQL = """
+    SELECT route_id, weighted_aadt, max_aadt, median_aadt, p90_aadt,
+           avg_truck_pct, match_rate, n_segments, total_length_ft
+    FROM route_traffic
+    WHERE match_rate >= ?
+"""
+
+
+def build_features() -> pl.DataFrame:
+    """Assemble structural features + traffic data for the regression model.
+
+    Only routes with match_rate >= MIN_MATCH_RATE are loaded, so stop spans are
+    computed for the routes the models actually use.
+    """
+    avg_otp = query_to_polars(AVG_OTP_SQL)
+    structure = query_to_polars(STRUCTURE_SQL)
+    stops_by_route = query_to_polars(STOP_COORDS_SQL, (MIN_MATCH_RATE,))
+    # Sorted by route, each route's stops are one contiguous run: convert the coordinates
+    # once and hand the span kernel array slices at the run offsets
+    stops_by_route = stops_by_route.sort("route_id")
+    lat = stops_by_route["lat"].to_numpy()
+    lon = stops_by_route["lon"].to_numpy()
+    runs = stops_by_route["route_id"].rle().struct.unnest()
+    ends = np.cumsum(runs["len"].to_numpy())
+    starts = ends - runs["len"].to_numpy()
+    span_df = pl.DataFrame({
+        "route_id": runs["value"],
+        "span_km": [compute_span(lat[i:j], lon[i:j]) for i, j in zip(starts, ends)],
+    }, schema={"route_id": pl.Utf8, "span_km": pl.Float64})
+
+    traffic = query_to_polars(TRAFFIC_SQL, (MIN_MATCH_RATE,))
 
     # Assemble
     df = avg_otp
-    df = df.join(stop_counts, on="route_id", how="left")
-    df = df.join(trips, on="route_id", how="left")
-    df = df.join(munis, on="route_id", how="left")
+    df = df.join(structure, on="route_id", how="left")
     df = df.join(span_df, on="route_id", how="left")
     df = df.join(traffic, on="route_id", how="inner")
 
-    # Derived features
+    # Derived features, evaluated together in one context (is_premium_bus needs bus_subtype)
     df = df.with_columns(
         pl.when(pl.col("max_wd") > 0)
         .then((pl.col("max_sa") + pl.col("max_su")) / (2.0 * pl.col("max_wd")))
         .otherwise(0.0)
         .alias("weekend_ratio"),
-    )
-    df = df.with_columns(
         pl.when(pl.col("mode") == "RAIL").then(1.0).otherwise(0.0).alias("is_rail"),
-    )
-    df = df.with_columns(
         pl.when(pl.col("mode") == "BUS")
-        .then(pl.col("route_id").map_elements(classify_bus_route, return_dtype=pl.Utf8))
+        .then(bus_route_class("route_id"))
         .otherwise(pl.lit("non_bus"))
         .alias("bus_subtype"),
+        pl.col("weighted_aadt").log().alias("log_aadt"),
     )
     df = df.with_columns(
         pl.when(pl.col("bus_subtype").is_in(["busway", "flyer", "express", "limited"]))
@@ -215,15 +259,34 @@ def load_features() -> pl.DataFrame:
         .otherwise(0.0)
         .alias("is_premium_bus"),
     )
-    df = df.with_columns(
-        pl.col("weighted_aadt").log().alias("log_aadt"),
-    )
 
     df = df.drop_nulls(subset=["stop_count", "span_km", "weekend_ratio", "n_munis"])
 
     return df
 
 
+def load_features() -> pl.DataFrame:
+    """Load the assembled feature table, reusing the cached copy until prt.db changes."""
+    return cached_frame(
+        CACHE, "features",
+        (AVG_OTP_SQL, STRUCTURE_SQL, STOP_COORDS_SQL, TRAFFIC_SQL, MIN_MATCH_RATE),
+        build_features,
+    )
+
+
+def load_excluded_routes() -> pl.DataFrame:
+    """Routes with OTP history whose traffic match_rate is below MIN_MATCH_RATE."""
+    return query_to_polars("""
+        SELECT t.route_id, t.match_rate
+        FROM route_traffic t
+        WHERE t.match_rate < ?
+          AND t.route_id IN (
+              SELECT route_id FROM otp_monthly GROUP BY route_id HAVING COUNT(*) >= 12
+          )
+        ORDER BY t.match_rate
+    """, (MIN_MATCH_RATE,))
+
+
 # ---------------------------------------------------------------------------
 # Charts
 # ---------------------------------------------------------------------------
@@ -235,9 +298,7 @@ def make_scatter_chart(df: pl.DataFrame) -> None:
 
     aadt = df["weighted_aadt"].to_numpy()
     otp = df["avg_otp"].to_numpy()
-    modes = df["mode"].to_list()
-
-    bus_mask = np.array([m == "BUS" for m in modes])
+    bus_mask = (df["mode"] == "BUS").to_numpy()
     rail_mask = ~bus_mask
 
     ax.scatter(aadt[bus_mask], otp[bus_mask], alpha=0.5, s=30, color="#2563eb",
@@ -289,9 +350,8 @@ def make_coefficient_chart(base: dict, expanded: dict) -> None:
     ax.barh(y_pos - width / 2, exp_vals, width, label="Expanded (+log_aadt)",
             color="#2563eb", alpha=0.7)
 
-    for i, f in enumerate(all_feats):
-        p = exp_pvals[f]
-        marker = "***" if p < 0.001 else "**" if p < 0.01 else "*" if p < 0.05 else ""
+    markers = significance_stars([exp_pvals[f] for f in all_feats])
+    for i, marker in enumerate(markers):
         val = exp_vals[i]
         ax.text(val + 0.01 if val >= 0 else val - 0.01, i - width / 2, marker,
                 ha="left" if val >= 0 else "right", va="center", fontsize=9)
@@ -350,18 +410,19 @@ def main() -> None:
     print("=" * 60)
 
     print("\nLoading and assembling features...")
-    df_all = load_features()
-    print(f"  {len(df_all)} routes with traffic + structural features")
-
-    # Filter by match rate
-    df = df_all.filter(pl.col("match_rate") >= MIN_MATCH_RATE)
-    excluded = df_all.filter(pl.col("match_rate") < MIN_MATCH_RATE)
-    n_rail = len(df.filter(pl.col("is_rail") == 1.0))
-    n_bus = len(df.filter(pl.col("mode") == "BUS"))
+    df = load_features()
+    excluded = load_excluded_routes()
+    print(f"  {len(df) + len(excluded)} routes with traffic + structural features")
+
+    # One boolean mask per mode, reused for the counts and the bus-only subgroup
+    mode = df["mode"].to_numpy()
+    bus_mask = mode == "BUS"
+    n_bus = int(bus_mask.sum())
+    n_rail = int((mode == "RAIL").sum())
     print(f"  {len(df)} routes after match_rate >= {MIN_MATCH_RATE} filter ({n_bus} BUS, {n_rail} RAIL)")
     if len(excluded) > 0:
         print(f"  Excluded ({len(excluded)}): "
-              + ", ".join(excluded.sort("match_rate")["route_id"].to_list()))
+              + ", ".join(excluded["route_id"].to_list()))
 
     print(f"\n  AADT range: {df['weighted_aadt'].min():,.0f} -- {df['weighted_aadt'].max():,.0f}")
     print(f"  Log AADT range: {df['log_aadt'].min():.2f} -- {df['log_aadt'].max():.2f}")
@@ -372,16 +433,16 @@ def main() -> None:
     # --- Model 1: Base (Analysis 18 replication, 6 features) ---
     base_features = ["stop_count", "span_km", "is_rail", "is_premium_bus",
                      "weekend_ratio", "n_munis"]
-    X_base = np.column_stack([df[f].to_numpy().astype(float) for f in base_features])
+    exp_features = base_features + ["log_aadt"]
+    X_exp = feature_matrix(df, exp_features)
+    design = qr_design(y, X_exp, exp_features)
     print("\nFitting base model (6 features, Analysis 18 replication)...")
-    base = fit_ols(y, X_base, base_features)
+    base = fit_ols(design, base_features)
     print_model(base, "Base model (6 features)")
 
     # --- Model 2: Expanded (+ log_aadt) ---
-    exp_features = base_features + ["log_aadt"]
-    X_exp = np.column_stack([df[f].to_numpy().astype(float) for f in exp_features])
     print("\nFitting expanded model (+ log_aadt)...")
-    expanded = fit_ols(y, X_exp, exp_features)
+    expanded = fit_ols(design, exp_features)
     print_model(expanded, "Expanded model (+ log_aadt)")
 
     # F-test
@@ -401,14 +462,14 @@ def main() -> None:
     if len(truck_df) >= 20:
         y_truck = truck_df["avg_otp"].to_numpy()
         truck_features = base_features + ["log_aadt", "avg_truck_pct"]
-        X_truck = np.column_stack([truck_df[f].to_numpy().astype(float) for f in truck_features])
+        # One factorization serves the truck model and the same-sample base model below
+        truck_design = qr_design(y_truck, feature_matrix(truck_df, truck_features), truck_features)
         print(f"\nFitting expanded model (+ log_aadt + avg_truck_pct, n={len(truck_df)})...")
-        truck_model = fit_ols(y_truck, X_truck, truck_features)
+        truck_model = fit_ols(truck_design, truck_features)
         print_model(truck_model, "Expanded model (+ log_aadt + avg_truck_pct)")
 
         # Compare vs base on same sample
-        X_base_truck = np.column_stack([truck_df[f].to_numpy().astype(float) for f in base_features])
-        base_truck = fit_ols(y_truck, X_base_truck, base_features)
+        base_truck = fit_ols(truck_design, base_features)
         f2, fp2 = f_test_nested(base_truck, truck_model)
         print(f"\n  F-test for log_aadt + truck_pct (joint): F = {f2:.3f}, p = {fp2:.4f}")
     else:
@@ -424,26 +485,29 @@ def main() -> None:
 
     # --- Correlation: log_aadt vs structural features ---
     print("\n--- Correlations: log_aadt vs structural features ---")
-    for feat in base_features:
-        r, p = stats.pearsonr(df[feat].to_numpy().astype(float), df["log_aadt"].to_numpy())
+    # X_exp is [base features | log_aadt]: one correlation matrix, p-values via the t-distribution
+    r_col = np.corrcoef(X_exp, rowvar=False)[:-1, -1]
+    n = len(y)
+    t_col = r_col * np.sqrt((n - 2) / (1 - r_col ** 2))
+    p_col = 2 * stats.t.sf(np.abs(t_col), n - 2)
+    for feat, r, p in zip(base_features, r_col, p_col):
         sig = "*" if p < 0.05 else ""
         print(f"  log_aadt vs {feat:<20s}: r = {r:+.3f}, p = {p:.4f} {sig}")
 
     # --- Bus-only subgroup ---
-    bus_df = df.filter(pl.col("mode") == "BUS")
+    bus_df = df.filter(pl.Series(bus_mask))
     y_bus = bus_df["avg_otp"].to_numpy()
     bus_base_feats = ["stop_count", "span_km", "is_premium_bus", "weekend_ratio", "n_munis"]
     bus_exp_feats = bus_base_feats + ["log_aadt"]
 
-    X_bus_base = np.column_stack([bus_df[f].to_numpy().astype(float) for f in bus_base_feats])
-    X_bus_exp = np.column_stack([bus_df[f].to_numpy().astype(float) for f in bus_exp_feats])
+    bus_design = qr_design(y_bus, feature_matrix(bus_df, bus_exp_feats), bus_exp_feats)
 
     print(f"\nFitting bus-only base model ({len(bus_df)} routes)...")
-    bus_base = fit_ols(y_bus, X_bus_base, bus_base_feats)
+    bus_base = fit_ols(bus_design, bus_base_feats)
     print_model(bus_base, "Bus-only base (5 features)")
 
     print(f"\nFitting bus-only expanded model (+ log_aadt)...")
-    bus_expanded = fit_ols(y_bus, X_bus_exp, bus_exp_feats)
+    bus_expanded = fit_ols(bus_design, bus_exp_feats)
     print_model(bus_expanded, "Bus-only expanded (+ log_aadt)")
 
     f_bus, fp_bus = f_test_nested(bus_base, bus_expanded)
@@ -455,7 +519,6 @@ def main() -> None:
     print("\nSaving CSVs...")
 
     # Model comparison
-    rows = []
     models = [
         (base, "base_6feat"),
         (expanded, "expanded_7feat_aadt"),
@@ -464,20 +527,23 @@ def main() -> None:
     ]
     if truck_model is not None:
         models.append((truck_model, "expanded_8feat_aadt_truck"))
+    # One column-wise frame per model, model-level stats broadcast
+    tables = []
     for model, label in models:
-        for i, feat in enumerate(model["features"]):
-            rows.append({
-                "model": label,
-                "feature": feat,
-                "coefficient": model["coefficients"][i],
-                "std_error": model["std_errors"][i],
-                "p_value": model["p_values"][i],
-                "beta_weight": model["beta_weights"][i] if model["beta_weights"][i] is not None else float("nan"),
-                "r_squared": model["r_squared"],
-                "adj_r_squared": model["adj_r_squared"],
-                "n": model["n"],
-            })
-    pl.DataFrame(rows).write_csv(OUT / "model_comparison.csv")
+        tables.append(pl.DataFrame({
+            "feature": model["features"],
+            "coefficient": model["coefficients"],
+            "std_error": model["std_errors"],
+            "p_value": model["p_values"],
+            "beta_weight": [float("nan")] + model["beta_weights"][1:],
+        }).select(
+            pl.lit(label).alias("model"),
+            pl.all(),
+            pl.lit(float(model["r_squared"])).alias("r_squared"),
+            pl.lit(float(model["adj_r_squared"])).alias("adj_r_squared"),
+            pl.lit(model["n"], dtype=pl.Int64).alias("n"),
+        ))
+    pl.concat(tables).write_csv(OUT / "model_comparison.csv")
     print(f"  {OUT / 'model_comparison.csv'}")
 
     # VIF table
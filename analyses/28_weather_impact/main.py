@@ -4,9 +4,14 @@ from pathlib import Path
 
 import numpy as np
 import polars as pl
-from scipy import stats
+from scipy import linalg, stats
 
-from prt_otp_analysis.common import output_dir, query_to_polars, setup_plotting
+from prt_otp_analysis.common import (
+    output_dir,
+    query_to_polars,
+    setup_plotting,
+    significance_stars,
+)
 
 HERE = Path(__file__).resolve().parent
 OUT = output_dir(HERE)
@@ -33,7 +38,17 @@ def fit_ols(y: np.ndarray, X_raw: np.ndarray, feature_names: list[str]) -> dict:
     n, k = X_raw.shape
     X = np.column_stack([np.ones(n), X_raw])
 
-    beta, _, _, _ = np.linalg.lstsq(X, y, rcond=None)
+    # One economic QR gives both beta and (X'X)^-1 = R^-1 R^-T
+    Q, R = linalg.qr(X, mode="economic", check_finite=False)
+    r_diag = np.abs(np.diag(R))
+    if r_diag.min() > r_diag.max() * n * np.finfo(np.float64).eps:
+        beta = linalg.solve_triangular(R, Q.T @ y, check_finite=False)
+        R_inv = linalg.solve_triangular(R, np.eye(k + 1), check_finite=False)
+        XtX_inv = R_inv @ R_inv.T
+    else:
+        # Rank-deficient design: minimum-norm solution via pivoted QR (gelsy)
+        beta = linalg.lstsq(X, y, lapack_driver="gelsy", check_finite=False)[0]
+        XtX_inv = np.linalg.pinv(X.T @ X)
     y_hat = X @ beta
     residuals = y - y_hat
 
@@ -43,10 +58,9 @@ def fit_ols(y: np.ndarray, X_raw: np.ndarray, feature_names: list[str]) -> dict:
     adj_r_squared = 1 - (1 - r_squared) * (n - 1) / (n - k - 1)
     mse = ss_res / (n - k - 1)
 
-    XtX_inv = np.linalg.pinv(X.T @ X)
     se = np.sqrt(np.diag(XtX_inv) * mse)
     t_vals = beta / se
-    p_vals = [2 * (1 - stats.t.cdf(abs(t), df=n - k - 1)) for t in t_vals]
+    p_vals = 2 * stats.t.sf(np.abs(t_vals), n - k - 1)
 
     # Standardized beta weights
     x_stds = np.std(X_raw, axis=0, ddof=1)
@@ -63,13 +77,42 @@ def fit_ols(y: np.ndarray, X_raw: np.ndarray, feature_names: list[str]) -> dict:
         "coefficients": beta.tolist(),
         "std_errors": se.tolist(),
         "t_values": t_vals.tolist(),
-        "p_values": p_vals,
+        "p_values": p_vals.tolist(),
         "beta_weights": [None] + beta_weights.tolist(),
         "y_hat": y_hat,
         "residuals": residuals,
+        "X": X,
+        "XtX_inv": XtX_inv,
     }
 
 
+def _masked_pearson(A: np.ndarray, B: np.ndarray) -> np.ndarray:
+    """Column-wise Pearson r between A and B, ignoring NaN rows (NaN in the same places)."""
+    dx = A - np.nanmean(A, axis=0)
+    dy = B - np.nanmean(B, axis=0)
+    return np.nansum(dx * dy, axis=0) / np.sqrt(np.nansum(dx * dx, axis=0) * np.nansum(dy * dy, axis=0))
+
+
+def column_correlations(X: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, ...]:
+    """Return (n, pearson_r, pearson_p, spearman_r, spearman_p) for each column of X vs y.
+
+    Each column uses the rows where both it and y are non-NaN. All columns are handled
+    by the same masked array reductions (Spearman = Pearson on ranks within each
+    column's rows), with p-values from the t-distribution on n - 2 df.
+    """
+    mask = ~np.isnan(X) & ~np.isnan(y)[:, None]
+    n = mask.sum(axis=0)
+    Xm = np.where(mask, X, np.nan)
+    Ym = np.where(mask, y[:, None], np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        r_p = _masked_pearson(Xm, Ym)
+        r_s = _masked_pearson(stats.rankdata(Xm, axis=0, nan_policy="omit"),
+                              stats.rankdata(Ym, axis=0, nan_policy="omit"))
+        p_p, p_s = (2 * stats.t.sf(np.abs(r * np.sqrt((n - 2) / (1 - r * r))), n - 2)
+                    for r in (r_p, r_s))
+    return n, r_p, p_p, r_s, p_s
+
+
 def f_test_nested(base: dict, full: dict) -> tuple[float, float]:
     """F-test comparing nested models. Returns (F_stat, p_value)."""
     k_diff = full["k"] - base["k"]
@@ -86,14 +129,14 @@ def print_model(results: dict, label: str) -> None:
           f"n = {results['n']}, k = {results['k']}")
     print(f"  {'Feature':<22s} {'Coeff':>10s} {'Std Err':>10s} {'p-value':>10s} {'Beta':>10s}")
     print(f"  {'-'*62}")
+    stars = significance_stars(results["p_values"])
     for i, feat in enumerate(results["features"]):
         coeff = results["coefficients"][i]
         se = results["std_errors"][i]
         p = results["p_values"][i]
         beta = results["beta_weights"][i]
         beta_str = f"{beta:>10.4f}" if beta is not None else f"{'--':>10s}"
-        sig = "***" if p < 0.001 else "**" if p < 0.01 else "*" if p < 0.05 else ""
-        print(f"  {feat:<22s} {coeff:>10.6f} {se:>10.6f} {p:>10.4f} {beta_str} {sig}")
+        print(f"  {feat:<22s} {coeff:>10.6f} {se:>10.6f} {p:>10.4f} {beta_str} {stars[i]}")
 
 
 # ---------------------------------------------------------------------------
@@ -176,13 +219,10 @@ def block_a(system: pl.DataFrame, weather: pl.DataFrame) -> pl.DataFrame:
     print(f"  {'Variable':<22s} {'Pearson r':>10s} {'p':>8s} {'Spearman r':>10s} {'p':>8s}")
     print(f"  {'-'*60}")
     corr_rows = []
-    for var in WEATHER_VARS:
-        x = merged[var].to_numpy().astype(float)
-        mask = ~np.isnan(x)
-        if mask.sum() < 10:
+    W = merged.select(pl.col(WEATHER_VARS).cast(pl.Float64)).to_numpy()
+    for var, n_obs, r_p, p_p, r_s, p_s in zip(WEATHER_VARS, *column_correlations(W, otp)):
+        if n_obs < 10:
             continue
-        r_p, p_p = stats.pearsonr(x[mask], otp[mask])
-        r_s, p_s = stats.spearmanr(x[mask], otp[mask])
         sig = "*" if p_p < 0.05 else ""
         print(f"  {var:<22s} {r_p:>+10.3f} {p_p:>8.4f} {r_s:>+10.3f} {p_s:>8.4f} {sig}")
         corr_rows.append({
@@ -215,14 +255,10 @@ def block_a(system: pl.DataFrame, weather: pl.DataFrame) -> pl.DataFrame:
     print(f"  {'Variable':<22s} {'Pearson r':>10s} {'p':>8s} {'Spearman r':>10s} {'p':>8s}")
     print(f"  {'-'*60}")
     otp_dt = dt["otp_detrended"].to_numpy()
-    for var in WEATHER_VARS:
-        col = f"{var}_detrended"
-        x = dt[col].to_numpy().astype(float)
-        mask = ~np.isnan(x) & ~np.isnan(otp_dt)
-        if mask.sum() < 10:
+    W_dt = dt.select(pl.col(f"{v}_detrended" for v in WEATHER_VARS).cast(pl.Float64)).to_numpy()
+    for var, n_obs, r_p, p_p, r_s, p_s in zip(WEATHER_VARS, *column_correlations(W_dt, otp_dt)):
+        if n_obs < 10:
             continue
-        r_p, p_p = stats.pearsonr(x[mask], otp_dt[mask])
-        r_s, p_s = stats.spearmanr(x[mask], otp_dt[mask])
         sig = "*" if p_p < 0.05 else ""
         print(f"  {var:<22s} {r_p:>+10.3f} {p_p:>8.4f} {r_s:>+10.3f} {p_s:>8.4f} {sig}")
         corr_rows.append({
@@ -322,17 +358,19 @@ def block_b(merged: pl.DataFrame) -> dict:
     print_model(model_both, "Month + weather model")
 
     # F-test: does weather add to month dummies?
-    # Realign month-only model to same observations
-    X1_masked = X1[mask3]
-    model_month_masked = fit_ols(y[mask3], X1_masked, names1)
+    # Realign month-only model to same observations (only refit if rows were dropped)
+    model_month_masked = model_month if mask3.all() else fit_ols(y[mask3], X1[mask3], names1)
     f_weather, fp_weather = f_test_nested(model_month_masked, model_both)
     print(f"\n  F-test (weather added to months): F = {f_weather:.3f}, p = {fp_weather:.4f}")
     print(f"  R2 change: {model_month_masked['r_squared']:.4f} -> {model_both['r_squared']:.4f} "
           f"(+{model_both['r_squared'] - model_month_masked['r_squared']:.4f})")
 
     # F-test: do month dummies add to weather?
-    X2_masked = X2[mask3]
-    model_weather_masked = fit_ols(y[mask3], X2_masked, names2)
+    # Month dummies are never NaN, so Model 2 normally already uses Model 3's rows
+    if np.array_equal(mask, mask3):
+        model_weather_masked = model_weather
+    else:
+        model_weather_masked = fit_ols(y[mask3], X2[mask3], names2)
     f_months, fp_months = f_test_nested(model_weather_masked, model_both)
     print(f"\n  F-test (months added to weather): F = {f_months:.3f}, p = {fp_months:.4f}")
     print(f"  R2 change: {model_weather_masked['r_squared']:.4f} -> {model_both['r_squared']:.4f} "
@@ -429,9 +467,9 @@ def block_c(route_otp: pl.DataFrame, weather: pl.DataFrame) -> dict:
     k = fe_model["k"]
     n = fe_model["n"]
 
-    # Compute cluster-robust (CR1) standard errors
-    X_with_const = np.column_stack([np.ones(n), X_clean])
-    XtX_inv = np.linalg.pinv(X_with_const.T @ X_with_const)
+    # Compute cluster-robust (CR1) standard errors, reusing the fit's design and (X'X)^-1
+    X_with_const = fe_model["X"]
+    XtX_inv = fe_model["XtX_inv"]
     meat = np.zeros((k + 1, k + 1))
     for m in unique_months:
         idx = months_arr == m
@@ -445,17 +483,17 @@ def block_c(route_otp: pl.DataFrame, weather: pl.DataFrame) -> dict:
     sandwich = XtX_inv @ meat @ XtX_inv * correction
     cluster_se = np.sqrt(np.diag(sandwich))
     cluster_t = np.array(fe_model["coefficients"]) / cluster_se
-    cluster_p = [2 * (1 - stats.t.cdf(abs(t), df=n_clusters - 1)) for t in cluster_t]
+    cluster_p = 2 * stats.t.sf(np.abs(cluster_t), n_clusters - 1)
 
     print(f"\n  Cluster-robust SEs (clustered by month, {n_clusters} clusters):")
     print(f"  {'Feature':<22s} {'Coeff':>10s} {'Cluster SE':>10s} {'p-value':>10s}")
     print(f"  {'-'*54}")
+    stars = significance_stars(cluster_p)
     for i, feat in enumerate(fe_model["features"]):
         coeff = fe_model["coefficients"][i]
         se = cluster_se[i]
         p = cluster_p[i]
-        sig = "***" if p < 0.001 else "**" if p < 0.01 else "*" if p < 0.05 else ""
-        print(f"  {feat:<22s} {coeff:>10.6f} {se:>10.6f} {p:>10.4f} {sig}")
+        print(f"  {feat:<22s} {coeff:>10.6f} {se:>10.6f} {p:>10.4f} {stars[i]}")
 
     return {
         "fe_model": fe_model,
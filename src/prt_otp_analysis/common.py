@@ -1,9 +1,16 @@
 """Shared utilities for analysis scripts: DB access, paths, and constants."""
 
+import functools
+import hashlib
+import inspect
 import sqlite3
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
 from pathlib import Path
 
+import numpy as np
 import polars as pl
+from scipy import stats
 
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
 DATA_DIR = PROJECT_ROOT / "data"
@@ -29,20 +36,117 @@ def output_dir(analysis_dir: str | Path) -> Path:
     return out
 
 
-def query_to_polars(sql: str, params: tuple = ()) -> pl.DataFrame:
-    """Execute a SQL query against prt.db and return results as a polars DataFrame."""
+@contextmanager
+def db_session() -> Iterator[sqlite3.Connection]:
+    """Yield one read-only connection to share across several queries, then close it."""
     conn = get_db()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def query_to_polars(
+    sql: str, params: tuple = (), conn: sqlite3.Connection | None = None
+) -> pl.DataFrame:
+    """Execute a SQL query against prt.db and return results as a polars DataFrame.
+
+    Pass `conn` (e.g. from db_session) to reuse an open connection; otherwise a
+    connection is opened and closed for this query alone.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db()
     try:
         rows = conn.execute(sql, params).fetchall()
         if not rows:
             return pl.DataFrame()
         return pl.DataFrame([dict(row) for row in rows])
     finally:
-        conn.close()
+        if own_conn:
+            conn.close()
+
 
+def cached_frame(
+    cache_dir: str | Path, name: str, key: object, build: Callable[[], pl.DataFrame]
+) -> pl.DataFrame:
+    """Return build(), reusing a Parquet copy of its result until prt.db changes.
 
+    The cache file is keyed by `name` plus a hash of `key` (e.g. the SQL that feeds
+    the frame) and of the source of the module defining `build` and of this module,
+    so editing the SQL or the Python that derives the frame forces a rebuild.
+    """
+    if not DB_PATH.exists():
+        return build()
+    sha = hashlib.sha1(repr(key).encode())
+    for source in sorted({inspect.getsourcefile(build) or __file__, __file__}):
+        sha.update(Path(source).read_bytes())
+    digest = sha.hexdigest()[:12]
+    cache = Path(cache_dir) / f"{name}-{digest}.parquet"
+    if cache.exists() and cache.stat().st_mtime > DB_PATH.stat().st_mtime:
+        return pl.scan_parquet(cache).collect()
+    df = build()
+    if df.width > 0:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        df.write_parquet(cache, compression="zstd")
+    return df
+
+
+def cached_query_to_polars(
+    sql: str, cache_dir: str | Path, name: str, params: tuple = ()
+) -> pl.DataFrame:
+    """Like query_to_polars, but reuse a Parquet copy of the result until prt.db changes."""
+    return cached_frame(cache_dir, name, (sql, params), lambda: query_to_polars(sql, params))
+
+
+def month_axis(months) -> dict:
+    """Return x-axis context for monthly charts, built once and shared across them.
+
+    Keys: `months` (str array; x = position), `index` (month -> x), `tick_positions`
+    (January positions) and `tick_labels` (their years).
+    """
+    months = np.asarray(months, dtype=str)
+    ticks = np.flatnonzero(np.char.endswith(months, "-01"))
+    return {
+        "months": months,
+        "index": {m: i for i, m in enumerate(months)},
+        "tick_positions": ticks,
+        "tick_labels": [m[:4] for m in months[ticks]],
+    }
+
+
+def corr_p_value(r: float, n: int) -> float:
+    """Two-sided p-value for a Pearson (or Spearman) r over n pairs, via the t-distribution."""
+    if abs(r) >= 1.0:
+        return 0.0
+    t = r * np.sqrt((n - 2) / (1 - r * r))
+    return float(2 * stats.t.sf(abs(t), n - 2))
+
+
+def pearson(x: np.ndarray, y: np.ndarray) -> tuple[float, float]:
+    """Pearson r and two-sided p-value from centered sums (Spearman = pearson on ranks)."""
+    dx = x - x.mean()
+    dy = y - y.mean()
+    r = float((dx * dy).sum() / np.sqrt((dx * dx).sum() * (dy * dy).sum()))
+    return r, corr_p_value(r, len(x))
+
+
+SIG_THRESHOLDS = np.array([0.001, 0.01, 0.05])
+SIG_STARS = np.array(["***", "**", "*", ""])
+
+
+def significance_stars(p_values) -> np.ndarray:
+    """Return the "***"/"**"/"*"/"" marker for each p-value (p < 0.001, 0.01, 0.05)."""
+    return SIG_STARS[np.searchsorted(SIG_THRESHOLDS, p_values, side="right")]
+
+
+@functools.cache
 def setup_plotting():
-    """Configure matplotlib defaults for consistent chart styling and return plt."""
+    """Configure matplotlib defaults for consistent chart styling and return plt.
+
+    Cached: the backend and rcParams are set on the first call; later calls from
+    other chart functions just return plt.
+    """
     import matplotlib
     matplotlib.use("Agg")
     import matplotlib.pyplot as plt
@@ -59,6 +163,11 @@ def setup_plotting():
     return plt
 
 
+# Busway routes run on dedicated right-of-way; other routes with these prefixes are flyers
+BUSWAY_ROUTES = ("P1", "P2", "P3", "G2")
+FLYER_PREFIXES = ("P", "G", "O")
+
+
 def classify_bus_route(route_id: str) -> str:
     """Classify a bus route_id as local, limited, express, busway, or flyer.
 
@@ -69,8 +178,21 @@ def classify_bus_route(route_id: str) -> str:
         return "limited"
     if route_id.endswith("X"):
         return "express"
-    if route_id in ("P1", "P2", "P3", "G2"):
+    if route_id in BUSWAY_ROUTES:
         return "busway"
-    if route_id.startswith(("P", "G", "O")):
+    if route_id.startswith(FLYER_PREFIXES):
         return "flyer"
     return "local"
+
+
+def bus_route_class(route_id: str = "route_id") -> pl.Expr:
+    """classify_bus_route as a native Polars expression over the route_id column."""
+    rid = pl.col(route_id)
+    return (
+        pl.when(rid.str.ends_with("L")).then(pl.lit("limited"))
+        .when(rid.str.ends_with("X")).then(pl.lit("express"))
+        .when(rid.is_in(BUSWAY_ROUTES)).then(pl.lit("busway"))
+        .when(pl.any_horizontal(rid.str.starts_with(p) for p in FLYER_PREFIXES))
+        .then(pl.lit("flyer"))
+        .otherwise(pl.lit("local"))
+    )
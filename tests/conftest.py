@@ -0,0 +1,7 @@
+"""Shared pytest configuration."""
+
+import sys
+from pathlib import Path
+
+# Ensure the source package is importable
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
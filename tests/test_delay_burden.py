@@ -0,0 +1,33 @@
+"""Regression tests for the route ranking in analysis 22 (passenger-weighted delay burden)."""
+
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+from prt_otp_analysis.common import DB_PATH
+
+MAIN_PY = Path(__file__).resolve().parents[1] / "analyses" / "22_delay_burden" / "main.py"
+
+
+@pytest.fixture(scope="module")
+def ranking():
+    """route_ranking() collected against the project database."""
+    if not DB_PATH.exists():
+        pytest.skip("prt.db has not been built")
+    spec = importlib.util.spec_from_file_location("analysis_22_delay_burden", MAIN_PY)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod.route_ranking().collect()
+
+
+def test_ranking_rows_in_burden_order(ranking):
+    """Rows must stay in burden order after the OTP-rank join."""
+    assert ranking["burden_rank"].to_list() == list(range(1, ranking.height + 1))
+    assert ranking["total_late"].is_sorted(descending=True)
+
+
+def test_top10_rows_are_largest_burdens(ranking):
+    """The first ten rows (main's top-10 table and share) hold the ten largest burdens."""
+    expected = ranking.top_k(10, by="total_late")["route_id"].sort()
+    assert ranking.head(10)["route_id"].sort().to_list() == expected.to_list()